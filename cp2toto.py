@@ -1,15 +1,8 @@
 import argparse
 import asyncio
-import re
 import sys
 import traceback
 
-from utils.menu import select_destination, select_origin
-from utils.misc import conversion_flow, remove_local_files
-from utils.output import bye, welcome
-from utils.scp_connect import scp
-from utils.tg import send_message_to_telegram_channel
-
 
 def main() -> None:
     """
@@ -21,6 +14,8 @@ def main() -> None:
     3. Asks the user to specify the destination folder where the files will be transferred
     4. Asks the user if they want to convert the files to MP4 with H.265 codec.
     5. Initiates file transfer process, copying selected files to the destination folder.
+       Converted files are uploaded as soon as they are ready, while the rest are still
+       being converted.
     6. If successful, it asks the user if they want to remove the original files.
     7. Also, if the destination folder is the 'movies/' folder, it asks to send a message
        to the Telegram channel.
@@ -29,6 +24,10 @@ def main() -> None:
     Args:
         -tg: Optional argument to send a message to the Telegram channel and skip the rest
              of the flow.
+        -y: Optional argument to answer yes to every confirmation but the removal of the
+            local files.
+        --plan-only: Optional argument to only show what would be converted, copied,
+            renamed and removed.
 
     The function handles two types of exceptions:
     - KeyboardInterrupt:
@@ -48,28 +47,81 @@ def main() -> None:
         action="store_true",
         help="Only send a message to the Telegram channel and skip the rest of the flow.",
     )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help=(
+            "Answer yes to the copy, conversion and renaming confirmations instead of "
+            "asking. Removing the local files is always asked."
+        ),
+    )
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help=(
+            "Show what would be converted, copied, renamed and removed, then exit "
+            "without doing any of it."
+        ),
+    )
     args = parser.parse_args()
 
+    # modules are imported only once they are needed, so the telegram only flow and
+    # quitting from the menus don't pay for loading paramiko, telethon and friends
     try:
+        from utils.output import bye, welcome
+
         welcome()
 
         if args.send_tg_message_only:
+            from utils.tg import send_message_to_telegram_channel
+
             asyncio.run(send_message_to_telegram_channel())
             sys.exit()
 
+        from utils.menu import select_destination, select_origin
+        from utils.misc import (
+            answer_yes,
+            ask_yes_no,
+            collect_file_names,
+            conversion_flow,
+            get_items_to_remove,
+            print_conversion_plan,
+            print_copy_plan,
+            print_items_to_remove,
+            remove_local_files,
+        )
+
+        # answers the copy, conversion and renaming questions
+        confirm = answer_yes if args.yes else ask_yes_no
+
         origin_files = select_origin()
         destination_folder = select_destination()
 
-        origin_files = conversion_flow(origin_files)
-        scp_completed = scp(origin_files, destination_folder)
+        if args.plan_only:
+            from utils.ssh_operations import print_rename_plan
+
+            source_files = list(collect_file_names(origin_files))
+            print_conversion_plan(source_files)
+            print_copy_plan(source_files, destination_folder)
+            print_rename_plan(source_files, destination_folder)
+            print_items_to_remove(get_items_to_remove(origin_files))
+            bye()
+
+        convert = conversion_flow(origin_files, confirm)
+
+        from utils.scp_connect import scp
+
+        copied_files = scp(origin_files, destination_folder, convert, confirm)
 
-        if scp_completed:
-            pattern = r"/(movies|series)/"
+        if copied_files:
+            if "/movies/" in destination_folder or "/series/" in destination_folder:
+                from utils.tg import send_message_to_telegram_channel
 
-            if re.search(pattern, destination_folder) is not None:
                 asyncio.run(send_message_to_telegram_channel())
 
-            remove_local_files(origin_files)
+            # whole folders can go, so this is asked even with --yes
+            remove_local_files(copied_files, ask_yes_no)
 
         bye()
 
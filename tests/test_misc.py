@@ -0,0 +1,109 @@
+import struct
+
+import pytest
+
+from utils.misc import _find_atom, mp4_video_codec
+
+
+def atom(kind: bytes, body: bytes = b"") -> bytes:
+    """
+    Build an mp4 atom with a regular 32-bit size header.
+    """
+    return struct.pack(">I4s", 8 + len(body), kind) + body
+
+
+def large_atom(kind: bytes, body: bytes = b"") -> bytes:
+    """
+    Build an mp4 atom with a size of 1, followed by its 64-bit size.
+    """
+    return struct.pack(">I4sQ", 1, kind, 16 + len(body)) + body
+
+
+def track(handler: bytes, codec: bytes) -> bytes:
+    """
+    Build a trak atom with the given handler type and sample description format.
+    """
+    hdlr: bytes = atom(b"hdlr", bytes(8) + handler + bytes(12))
+    stsd: bytes = atom(b"stsd", bytes(4) + struct.pack(">I", 1) + atom(codec, bytes(8)))
+    minf: bytes = atom(b"minf", atom(b"stbl", stsd))
+    return atom(b"trak", atom(b"mdia", hdlr + minf))
+
+
+def write_mp4(tmp_path, *atoms: bytes) -> str:
+    """
+    Write the atoms to an mp4 file and return its path.
+    """
+    file_path = tmp_path / "video.mp4"
+    file_path.write_bytes(b"".join(atoms))
+    return str(file_path)
+
+
+def test_find_atom_descends_the_path():
+    data: bytes = atom(b"free", b"1234") + atom(b"moov", atom(b"trak", b"body"))
+    start, end = _find_atom(data, 0, len(data), b"moov", b"trak")
+    assert data[start:end] == b"body"
+
+
+def test_find_atom_missing():
+    data: bytes = atom(b"moov", atom(b"trak", b"body"))
+    assert _find_atom(data, 0, len(data), b"moov", b"mdia") is None
+
+
+def test_find_atom_size_zero_runs_to_the_end():
+    data: bytes = atom(b"free") + struct.pack(">I4s", 0, b"mdat") + b"payload"
+    start, end = _find_atom(data, 0, len(data), b"mdat")
+    assert data[start:end] == b"payload"
+
+
+def test_find_atom_size_one_reads_the_64_bit_size():
+    data: bytes = large_atom(b"moov", atom(b"trak", b"body")) + atom(b"free")
+    start, end = _find_atom(data, 0, len(data), b"moov", b"trak")
+    assert data[start:end] == b"body"
+
+
+def test_find_atom_size_below_header_is_rejected():
+    data: bytes = struct.pack(">I4s", 4, b"moov") + bytes(8)
+    assert _find_atom(data, 0, len(data), b"moov") is None
+
+
+@pytest.mark.parametrize(
+    ("codec", "expected"),
+    [(b"hvc1", "hevc"), (b"hev1", "hevc"), (b"avc1", "h264"), (b"mp4v", None)],
+)
+def test_mp4_video_codec(tmp_path, codec, expected):
+    file_path: str = write_mp4(
+        tmp_path, atom(b"ftyp", b"isom"), atom(b"moov", track(b"vide", codec))
+    )
+    assert mp4_video_codec(file_path) == expected
+
+
+def test_mp4_video_codec_skips_tracks_that_are_not_video(tmp_path):
+    moov: bytes = atom(b"moov", track(b"soun", b"mp4a") + track(b"vide", b"hvc1"))
+    file_path: str = write_mp4(tmp_path, atom(b"ftyp", b"isom"), moov)
+    assert mp4_video_codec(file_path) == "hevc"
+
+
+def test_mp4_video_codec_moov_after_mdat(tmp_path):
+    file_path: str = write_mp4(
+        tmp_path,
+        atom(b"ftyp", b"isom"),
+        large_atom(b"mdat", bytes(64)),
+        atom(b"moov", track(b"vide", b"avc1")),
+    )
+    assert mp4_video_codec(file_path) == "h264"
+
+
+def test_mp4_video_codec_moov_running_to_the_end(tmp_path):
+    moov: bytes = struct.pack(">I4s", 0, b"moov") + track(b"vide", b"hvc1")
+    file_path: str = write_mp4(tmp_path, atom(b"ftyp", b"isom"), moov)
+    assert mp4_video_codec(file_path) == "hevc"
+
+
+def test_mp4_video_codec_without_video_track(tmp_path):
+    file_path: str = write_mp4(tmp_path, atom(b"moov", track(b"soun", b"mp4a")))
+    assert mp4_video_codec(file_path) is None
+
+
+def test_mp4_video_codec_without_moov(tmp_path):
+    file_path: str = write_mp4(tmp_path, atom(b"ftyp", b"isom"), atom(b"mdat", b"x"))
+    assert mp4_video_codec(file_path) is None
@@ -0,0 +1,61 @@
+import subprocess
+
+import pytest
+
+from utils import ssh_operations
+from utils.ssh_operations import get_rsync_version, get_season, plan_renames
+
+
+@pytest.fixture
+def rsync_output(monkeypatch):
+    """
+    Make `rsync --version` print the given text.
+    """
+
+    def set_output(output: str) -> None:
+        monkeypatch.setattr(
+            ssh_operations.subprocess,
+            "run",
+            lambda command, **kwargs: subprocess.CompletedProcess(command, 0, output, ""),
+        )
+        get_rsync_version.cache_clear()
+
+    yield set_output
+    get_rsync_version.cache_clear()
+
+
+@pytest.mark.parametrize(
+    ("output", "expected"),
+    [
+        ("rsync  version 3.2.7  protocol version 31\nCopyright ...\n", (3, 2)),
+        ("rsync  version 2.6.9  protocol version 29\n", (2, 6)),
+        ("openrsync: protocol version 29\nrsync version 2.6.9 compatible\n", (2, 6)),
+        ("", (0, 0)),
+    ],
+)
+def test_get_rsync_version(rsync_output, output, expected):
+    rsync_output(output)
+    assert get_rsync_version() == expected
+
+
+def test_get_season():
+    assert get_season("/media/series/The Office/Season1/") == ("The Office", "01")
+    assert get_season("/media/series/Dark/S03") == ("Dark", "03")
+
+
+def test_get_season_without_number():
+    assert get_season("/media/series/The Office/Extras/") is None
+
+
+def test_plan_renames():
+    file_names: list = [
+        "._The.Office.S01E02.mkv",
+        "The Office_S01_E03.mkv",
+        "The.Office.S01E01.720p.mkv",
+        "The.Office.S01E02.srt",
+        "notes.txt",
+    ]
+    assert plan_renames(file_names, "The Office", "01") == [
+        ("The.Office.S01E01.720p.mkv", "The Office_S01_E01.mkv"),
+        ("The.Office.S01E02.srt", "The Office_S01_E02.srt"),
+    ]
@@ -14,6 +14,17 @@ comedy_folder: str = os.getenv("SERVER_COMEDY_FOLDER")
 destination_base_folder: str = os.getenv("SERVER_DESTINATION_BASE_FOLDER")
 server_name: str = os.getenv("SERVER_NAME")
 server_user: str = os.getenv("SERVER_USER")
+ssh_target: str = f"{server_user}@{server_name}"
+# bandwidth-delay product of the link to the server, files smaller than this can't fill
+# the link on their own so several of them are uploaded at the same time
+transfer_bdp_bytes: int = int(os.getenv("TRANSFER_BDP_BYTES", 16 * 1024 * 1024))
+# keep well below the MaxStartups limit of the server's sshd
+max_ssh_connections: int = int(os.getenv("MAX_SSH_CONNECTIONS", 4))
+# SFTP channels opened on each of those connections, keep below the server's MaxSessions
+sftp_channels: int = int(os.getenv("SFTP_CHANNELS", 2))
+ssh_compression: bool = os.getenv("SSH_COMPRESSION", "false").lower() in ["true", "yes"]
+# "sftp" uploads through paramiko, "scp" and "rsync" hand the upload to that binary
+transfer_backend: str = os.getenv("TRANSFER_BACKEND", "sftp")
 
 telegram_personal_phone_number: str = os.getenv("TELEGRAM_PERSONAL_PHONE_NUMBER")
 telegram_personal_nickname: str = os.getenv("TELEGRAM_PERSONAL_NICKNAME")
@@ -25,3 +36,19 @@ telegram_channel_name: str = (
     else os.getenv("TEST_CHANNEL_NAME")
 )
 omdb_api_key: str = os.getenv("OMDB_API_KEY")
+
+# a single x265 encode already keeps around 8 cores busy, only run conversions side by
+# side when there are cores left idle
+conversion_workers: int = int(
+    os.getenv("CONVERSION_WORKERS", max(1, (os.cpu_count() or 1) // 8))
+)
+# split the cores between the conversions running side by side, libx265 gets this many
+# threads in its pool and the hardware encoders this many ffmpeg threads
+ffmpeg_threads: int = int(
+    os.getenv("FFMPEG_THREADS") or max(1, (os.cpu_count() or 1) // conversion_workers)
+)
+# "auto" picks the first working hardware HEVC encoder and falls back to libx265, any
+# ffmpeg encoder name (hevc_nvenc, hevc_qsv, hevc_vaapi, ...) forces that one
+video_encoder: str = os.getenv("VIDEO_ENCODER", "auto")
+# average bitrate for a two-pass libx265 encode (e.g. "2500k"), unset keeps CRF 23
+x265_bitrate: str = os.getenv("X265_BITRATE")
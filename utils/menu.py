@@ -1,3 +1,8 @@
+import os
+import queue
+import threading
+
+from functools import lru_cache
 from pathlib import Path
 
 from simple_term_menu import TerminalMenu
@@ -5,39 +10,126 @@ from termcolor import colored
 
 from utils.config import destination_base_folder, origin_folder, series_folder
 from utils.output import bye
-from utils.ssh_operations import mount_ask
 
+# Folder listings remembered, the least recently used one is dropped first
+LISTING_CACHE_SIZE: int = 64
+# Subfolders listed in the background while the user looks at a menu, so entering one
+# of them is served from the listing cache. Each menu adds up to PREFETCH_MAX_FOLDERS
+# listings to the cache, so an eighth of it lets the user go seven levels down before
+# the prefetch starts dropping the folders they came from.
+PREFETCH_WORKERS: int = 8
+PREFETCH_MAX_FOLDERS: int = LISTING_CACHE_SIZE // 8
 
-def get_list_of_items(folder_path: str) -> list:
-    """
-    Retrieve and return a sorted list of items (directories and files) from a specified
-    folder path.
+# folders waiting to be listed by the prefetch threads
+_prefetch_queue: queue.Queue = queue.Queue()
 
-    If the specified folder is not found, the function prompts the user to mount the media
-    folder and attempts to retrieve the list of items again.
+
+@lru_cache(maxsize=LISTING_CACHE_SIZE)
+def _list_cached(folder_path: str) -> tuple:
+    """
+    List a folder once and remember the result, so going back and forth through the
+    same folders in the menus does not hit the (possibly network mounted) disk again.
 
     Args:
         folder_path (str): The path of the folder from which to retrieve items.
 
     Returns:
-        list: A sorted list of directories and files in the specified folder.
+        tuple: The sorted directories and the sorted files of the folder.
     """
-    path: Path = Path(folder_path)
     dirs: list = []
     files: list = []
-    try:
-        for item in path.iterdir():
-            if item.is_dir():
-                dirs.append(item.name)
+    # DirEntry.is_dir() relies on the file type reported by the directory listing,
+    # so no extra stat() call is needed per entry (except for symlinks)
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                dirs.append(entry.name)
             else:
-                files.append(item.name)
+                files.append(entry.name)
+
+    return tuple(sorted(dirs)), tuple(sorted(files))
+
+
+def _prefetch_worker() -> None:
+    """
+    List the folders put on the queue by _prefetch_listings(), forever.
+    """
+    while True:
+        folder_path: str = _prefetch_queue.get()
+        try:
+            _list_cached(folder_path)
+        except OSError:
+            # the menu lists the folder again, and reports the error, if it is entered
+            pass
+
+
+# daemon threads rather than a ThreadPoolExecutor, whose threads are joined at exit, so
+# quitting from a menu never waits on a listing stuck on an unresponsive mount
+for _ in range(PREFETCH_WORKERS):
+    threading.Thread(target=_prefetch_worker, name="prefetch", daemon=True).start()
+
+
+def _prefetch_listings(folder_path: str, dirs: tuple) -> None:
+    """
+    List the subfolders of a folder in the background, filling the listing cache.
+
+    Args:
+        folder_path (str): The folder being displayed.
+        dirs (tuple): The names of its subfolders.
+    """
+    for folder in dirs[:PREFETCH_MAX_FOLDERS]:
+        _prefetch_queue.put_nowait(os.path.join(folder_path, folder))
+
+
+def list_folder(folder_path: str) -> tuple:
+    """
+    Retrieve the sorted directories and files of a folder.
+
+    If the specified folder is not found, the function prompts the user to mount the media
+    folder and attempts to retrieve the items once more.
+
+    Args:
+        folder_path (str): The path of the folder from which to retrieve items.
+
+    Returns:
+        tuple: The sorted directories and the sorted files in the specified folder.
+
+    Raises:
+        FileNotFoundError: If the folder is still missing after mounting.
+    """
+    for attempt in range(2):
+        try:
+            dirs, files = _list_cached(folder_path)
+            break
+
+        except FileNotFoundError as fnf_error:
+            if attempt:
+                raise
 
-    except FileNotFoundError as fnf_error:
-        print(f"An error occurred: {fnf_error}")
-        mount_ask()
-        return get_list_of_items(folder_path)
+            from utils.ssh_operations import mount_ask
 
-    return sorted(dirs) + sorted(files)
+            print(f"An error occurred: {fnf_error}")
+            # listings taken before the media folder was (re)mounted are stale
+            _list_cached.cache_clear()
+            mount_ask()
+
+    _prefetch_listings(folder_path, dirs)
+    return dirs, files
+
+
+def get_list_of_items(folder_path: str) -> list:
+    """
+    Retrieve and return a sorted list of items (directories and files) from a specified
+    folder path.
+
+    Args:
+        folder_path (str): The path of the folder from which to retrieve items.
+
+    Returns:
+        list: A sorted list of directories and files in the specified folder.
+    """
+    dirs, files = list_folder(folder_path)
+    return [*dirs, *files]
 
 
 def menu(selectable_items: list, add_done_option: bool = False) -> list:
@@ -58,10 +150,11 @@ def menu(selectable_items: list, add_done_option: bool = False) -> list:
         list: The list of items selected by the user.
     """
     try:
-        selectable_items += [".."]
+        # build a new list, the caller's one may be a cached directory listing
+        selectable_items = [*selectable_items, ".."]
 
         if add_done_option:
-            selectable_items += ["DONE"]
+            selectable_items.append("DONE")
 
         terminal_menu: TerminalMenu = TerminalMenu(
             selectable_items,
@@ -112,9 +205,7 @@ def select_destination() -> str:
     return destination
 
 
-def select_origin(
-    current_folder=origin_folder, pre_selected_items=[], selection_is_done=False
-):
+def select_origin(current_folder: str = origin_folder) -> list:
     """
     Interactively prompt the user to select the origin files for the file transfer.
 
@@ -122,43 +213,37 @@ def select_origin(
     multiple files. The selection process can be terminated by selecting the "DONE" option
 
     Args:
-        current_folder (str, optional): The current folder path. Defaults to origin_folder
-        pre_selected_items (list, optional): The list of items that have been pre-selected
-                                             Defaults to [].
-        selection_is_done (bool, optional): A flag indicating whether the selection
-                                            process is complete. Defaults to False.
+        current_folder (str, optional): The folder to start browsing from.
+                                        Defaults to origin_folder.
 
     Returns:
-        list: A list of dictionaries, where each dictionary represents a folder and
-        contains the selected items from that folder.
-    """
-
-    if selection_is_done:
-        return pre_selected_items
-
-    add_done_option = False
-    current_folder = str(Path(current_folder).resolve())
-    if current_folder == origin_folder:
-        add_done_option = True
-
-    selected_items = menu(get_list_of_items(current_folder), add_done_option)
-    if not selected_items:
-        bye()
-
-    item = selected_items[-1]
-    if item == "DONE":
-        for selected_item in selected_items[:-1]:
-            if not isinstance(selected_item, list):
-                selected_item = [selected_item]
-            pre_selected_items.append({current_folder: selected_item})
-        return select_origin(
-            pre_selected_items=pre_selected_items, selection_is_done=True
-        )
-
-    elif Path(f"{current_folder}/{item}").is_dir():
-        pre_selected_items.append({current_folder: selected_items[:-1]})
-        return select_origin(f"{current_folder}/{item}", pre_selected_items)
-
-    # this is when the user doesn't properly select with space, so we just add the item
-    # to the list of selected items and continue, assuming it is just "the one file".
-    return [{current_folder: [item]}]
+        list: A list of tuples, each one holding the path of a folder and the list of
+        items selected in that folder.
+    """
+    selected_origin: list = []
+
+    while True:
+        current_path: Path = Path(current_folder).resolve()
+        current_folder = str(current_path)
+        add_done_option: bool = current_folder == origin_folder
+
+        dirs, files = list_folder(current_folder)
+        selected_items = menu([*dirs, *files], add_done_option)
+        if not selected_items:
+            bye()
+
+        item = selected_items[-1]
+        if item == "DONE":
+            for selected_item in selected_items[:-1]:
+                selected_origin.append((current_folder, [selected_item]))
+            return selected_origin
+
+        # the listing already tells which items are folders, no need to stat them again
+        if item == ".." or item in dirs:
+            selected_origin.append((current_folder, selected_items[:-1]))
+            current_folder = str(current_path / item)
+            continue
+
+        # this is when the user doesn't properly select with space, so we just add the
+        # item to the list of selected items, assuming it is just "the one file".
+        return [(current_folder, [item])]
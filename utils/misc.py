@@ -1,37 +1,137 @@
+import asyncio
 import os
+import re
 import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 
+from collections.abc import Callable, Iterator
+from functools import cache, lru_cache
+from itertools import chain
 from pathlib import Path
 
 import ffmpeg
 
 from termcolor import colored
 
-from utils.config import origin_folder
+from utils.config import (
+    conversion_workers,
+    ffmpeg_threads,
+    origin_folder,
+    video_encoder,
+    x265_bitrate,
+)
+
+SIZE_UNITS: tuple = ("B", "KB", "MB", "GB", "TB")
+
+# Files that are known to hold H.265 video from their name alone
+HEVC_SUFFIXES: tuple = ("_H265.mp4", ".hevc", ".h265")
+
+# mp4 and mov files have their codec read from the sample description of the video
+# track, found at moov/trak/mdia/minf/stbl/stsd, instead of running ffprobe
+MP4_EXTENSIONS: tuple = (".mp4", ".m4v", ".mov")
+MP4_SAMPLE_DESCRIPTION: tuple = (b"mdia", b"minf", b"stbl", b"stsd")
+MP4_VIDEO_CODECS: dict = {
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"avc1": "h264",
+    b"avc3": "h264",
+}
+
+# Conversions that, after EARLY_ABORT_PROGRESS of the video, are on track to end up
+# bigger than EARLY_ABORT_RATIO of the original are given up
+EARLY_ABORT_PROGRESS: float = 0.05
+EARLY_ABORT_RATIO: float = 0.9
+# Percentage points between two progress lines of a conversion
+CONVERSION_PROGRESS_STEP: int = 10
+# Duration of the input as ffmpeg logs it
+DURATION_PATTERN: re.Pattern = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+SOFTWARE_ENCODER: str = "libx265"
+# Most worker threads x265 accepts in its thread pool
+X265_MAX_POOL_THREADS: int = 64
+# Hardware HEVC encoders in order of preference, with the ffmpeg input and output
+# options each one needs. Decoding stays on the GPU where ffmpeg supports it, and falls
+# back to the CPU for codecs the GPU can't decode.
+VAAPI_DEVICE: str = "/dev/dri/renderD128"
+HARDWARE_ENCODERS: dict = {
+    "hevc_nvenc": (
+        {"hwaccel": "cuda", "hwaccel_output_format": "cuda"},
+        {"preset": "p5", "rc": "vbr", "cq": 23, "b:v": "0"},
+    ),
+    "hevc_qsv": (
+        {"init_hw_device": "qsv=hw", "filter_hw_device": "hw"},
+        {"vf": "format=nv12,hwupload=extra_hw_frames=64", "global_quality": 23},
+    ),
+    "hevc_vaapi": (
+        {
+            "vaapi_device": VAAPI_DEVICE,
+            "hwaccel": "vaapi",
+            "hwaccel_output_format": "vaapi",
+        },
+        {"vf": "format=nv12|vaapi,hwupload", "qp": 23},
+    ),
+    "hevc_videotoolbox": ({}, {"q:v": 65, "tag:v": "hvc1"}),
+    "hevc_amf": ({}, {"rc": "cqp", "qp_i": 23, "qp_p": 23}),
+}
+
+# ffmpeg processes of the conversions running right now, and whether cancel_conversions()
+# was called, both guarded by the lock
+_conversion_processes: set = set()
+_conversions_cancelled: bool = False
+_conversions_lock: threading.Lock = threading.Lock()
+
+
+# colored line templates for the per-file loops, built once and filled in with format()
+FILE_TO_COPY_LINE: str = (
+    colored("- {}", "cyan", attrs=["bold"])
+    + " "
+    + colored("({})", "magenta", attrs=["bold"])
+)
+FILE_TO_REMOVE_LINE: str = colored(" - {} {}", "red")
+DIRECTORY_TAG: str = colored("(directory)", "cyan")
+FILE_REMOVED_LINE: str = colored("Removed:", "red") + " " + colored("{}", "cyan")
+
+
+class ConversionCancelled(Exception):
+    """
+    Raised in the conversions that are still running when they get cancelled.
+    """
+
+
+@cache
+def get_file_size(file_path: str) -> int:
+    """
+    Get the size of a local file, asking the file system only once per run.
+
+    The same selection is listed by the conversion and the copy confirmations and then
+    weighed again to pick the transfer method, which on a network mounted origin folder
+    means a round trip to the server every time.
 
+    Args:
+        file_path (str): The path of the file.
 
-def print_files_to_copy(origin_files: list) -> None:
+    Returns:
+        int: The size of the file in bytes.
+    """
+    return os.path.getsize(file_path)
+
+
+def print_files_to_copy(source_files: list) -> None:
     """
     Print the names of the files that are about to be copied.
 
     Args:
-        origin_files (list): A list of dictionaries.
-        Each dictionary represents a directory and contains pairs of directory path and
-        list of file names in that directory.
-    """
-    for full_item in origin_files:
-        item_folder_path = f"{list(full_item.keys())[0]}"
-        for file_names in full_item.values():
-            for file_name in file_names:
-                file_size = format_size(
-                    os.path.getsize(f"{item_folder_path}/{file_name}")
-                )
-                msg: str = colored(f"- {file_name}", "cyan", attrs=["bold"])
-                print(msg, end=" ")
-                msg = colored(f"({file_size})", "magenta", attrs=["bold"])
-                print(msg)
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+    """
+    for source_file, file_name in source_files:
+        file_size = format_size(get_file_size(source_file))
+        print(FILE_TO_COPY_LINE.format(file_name, file_size))
 
 
 def get_new_file_name(origin_file: str) -> str:
@@ -50,18 +150,43 @@ def get_new_file_name(origin_file: str) -> str:
     return f"{origin_file_directory}/{origin_file_name}_H265.mp4"
 
 
-def confirmation_flow(origin_files: list, destination_folder: str) -> bool:
+def ask_yes_no(prompt: str) -> bool:
     """
-    Prompt the user to confirm the file transfer.
+    Ask the user a yes/no question.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
-        destination_folder (str): The destination folder path.
+        prompt (str): The question to ask.
 
     Returns:
-        bool: True if the user confirms the file transfer, False otherwise.
+        bool: True if the answer is yes, False otherwise.
+    """
+    return input(prompt).lower() in ["y", "yes"]
+
+
+def answer_yes(prompt: str) -> bool:
+    """
+    Answer a yes/no question with yes without asking, showing the question and answer.
+
+    Used in place of ask_yes_no() to confirm the steps of an unattended run.
+
+    Args:
+        prompt (str): The question being answered.
+
+    Returns:
+        bool: Always True.
+    """
+    print(f"{prompt}y")
+    return True
+
+
+def print_copy_plan(source_files: list, destination_folder: str) -> None:
+    """
+    Print the files that are about to be copied and where they are going.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The destination folder path.
     """
     msg: str = colored(
         "\nYou are about to copy the following files/folders into",
@@ -70,25 +195,48 @@ def confirmation_flow(origin_files: list, destination_folder: str) -> bool:
     )
     destination_msg: str = colored(destination_folder, "red", attrs=["bold"])
     print(msg, destination_msg)
-    print_files_to_copy(origin_files)
-    copy_confirmation: str = input(
-        colored("\nConfirm to copy [y/N]: ", "green", attrs=["bold"])
-    )
-    if copy_confirmation.lower() in ["y", "yes"]:
-        return True
+    print_files_to_copy(source_files)
+
+
+def confirmation_flow(
+    source_files: list,
+    destination_folder: str,
+    confirm: Callable[[str], bool] = ask_yes_no,
+) -> bool:
+    """
+    Prompt the user to confirm the file transfer.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The destination folder path.
+        confirm (Callable[[str], bool], optional): Asks a yes/no question and returns
+        the answer. Defaults to ask_yes_no.
+
+    Returns:
+        bool: True if the user confirms the file transfer, False otherwise.
+    """
+    print_copy_plan(source_files, destination_folder)
+    return confirm(colored("\nConfirm to copy [y/N]: ", "green", attrs=["bold"]))
 
 
-def conversion_flow(origin_files: list) -> list:
+def conversion_flow(
+    origin_files: list, confirm: Callable[[str], bool] = ask_yes_no
+) -> bool:
     """
     Ask the user if they want to convert the files to mp4 with H.265 codec before copying.
 
+    The conversion itself happens during the transfer, so each file is uploaded as soon
+    as it has been converted.
+
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        confirm (Callable[[str], bool], optional): Asks a yes/no question and returns
+        the answer. Defaults to ask_yes_no.
 
     Returns:
-        list: The updated list of origin files after conversion.
+        bool: True if the user wants the files to be converted, False otherwise.
     """
     print(
         colored(
@@ -99,67 +247,559 @@ def conversion_flow(origin_files: list) -> list:
         )
     )
     print(colored("This can be a lengthy process.", "magenta", attrs=["bold"]))
-    print_files_to_copy(origin_files)
-    convert_confirmation: str = input(
-        colored("\nConfirm conversion [y/N]: ", "yellow", attrs=["bold"])
+    # the files are listed once, by the copy confirmation that follows
+    return confirm(colored("\nConfirm conversion [y/N]: ", "yellow", attrs=["bold"]))
+
+
+async def convert_files(file_paths: list, backlog: asyncio.Semaphore = None):
+    """
+    Convert several files to mp4 with H.265 codec concurrently, yielding each file as soon
+    as its conversion is done.
+
+    Each conversion runs its ffmpeg process from a worker thread, and at most
+    conversion_workers of them run at the same time.
+
+    Args:
+        file_paths (list): The paths of the files to convert.
+        backlog (asyncio.Semaphore, optional): Acquired before each conversion starts and
+        left for the caller to release once it is done with the converted file, which
+        caps how many converted files can pile up on disk. Defaults to None.
+
+    Yields:
+        tuple: The original file path and the path of the resulting file.
+    """
+    semaphore = asyncio.Semaphore(conversion_workers)
+    # pick the encoder before the workers start, so it is only probed once
+    await asyncio.to_thread(get_video_encoder)
+
+    async def convert(file_path: str) -> tuple:
+        if backlog is not None:
+            await backlog.acquire()
+        async with semaphore:
+            return file_path, await asyncio.to_thread(convert_to_H265_codec, file_path)
+
+    for conversion in asyncio.as_completed([convert(path) for path in file_paths]):
+        yield await conversion
+
+
+def update_file_names(origin_files: list, new_file_paths: dict) -> list:
+    """
+    Build a new list of origin files replacing the converted files with their new names.
+
+    Args:
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        new_file_paths (dict): The path of each converted file, keyed by the path of the
+        original file.
+
+    Returns:
+        list: The updated list of origin files after conversion.
+    """
+    return [
+        (
+            directory,
+            [
+                Path(new_file_paths[f"{directory}/{file_name}"]).name
+                for file_name in file_names
+            ],
+        )
+        for directory, file_names in origin_files
+        if file_names
+    ]
+
+
+@cache
+def get_video_encoder() -> str:
+    """
+    Pick the H.265 encoder used for the conversions, once per run.
+
+    Unless VIDEO_ENCODER names one, the hardware encoders ffmpeg was built with are tried
+    in order of preference with a tiny test encode, since being listed doesn't mean the
+    GPU (or its driver) is actually there.
+
+    Returns:
+        str: The name of the ffmpeg encoder to use.
+    """
+    if video_encoder != "auto":
+        return video_encoder
+
+    try:
+        encoders: str = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True
+        ).stdout
+    except FileNotFoundError:
+        return SOFTWARE_ENCODER
+
+    available: set = {
+        fields[1] for fields in map(str.split, encoders.splitlines()) if len(fields) > 1
+    }
+    for encoder, (input_options, output_options) in HARDWARE_ENCODERS.items():
+        if encoder not in available:
+            continue
+        try:
+            ffmpeg.input(
+                "color=c=black:s=256x256:d=0.1", f="lavfi", **input_options
+            ).output("-", f="null", vcodec=encoder, **output_options).run(quiet=True)
+        except ffmpeg.Error:
+            continue
+        return encoder
+
+    return SOFTWARE_ENCODER
+
+
+def cancel_conversions() -> None:
+    """
+    Stop the ffmpeg processes of the conversions running right now, and any started
+    afterwards, so a failing transfer doesn't have to wait for them to finish.
+    """
+    global _conversions_cancelled
+    with _conversions_lock:
+        _conversions_cancelled = True
+        for process in _conversion_processes:
+            process.terminate()
+
+
+def start_ffmpeg(stream):
+    """
+    Start ffmpeg for a stream in the background, keeping track of it for
+    cancel_conversions().
+
+    Args:
+        stream: The ffmpeg-python output stream to run.
+
+    Returns:
+        subprocess.Popen: The ffmpeg process, with its stdout and stderr piped.
+
+    Raises:
+        ConversionCancelled: If the conversions have been cancelled.
+    """
+    with _conversions_lock:
+        if _conversions_cancelled:
+            raise ConversionCancelled()
+        process = stream.overwrite_output().run_async(pipe_stdout=True, pipe_stderr=True)
+        _conversion_processes.add(process)
+    return process
+
+
+def finish_ffmpeg(process) -> None:
+    """
+    Stop keeping track of a finished ffmpeg process started with start_ffmpeg().
+
+    Args:
+        process (subprocess.Popen): The finished ffmpeg process.
+
+    Raises:
+        ConversionCancelled: If the conversions were cancelled while it was running.
+    """
+    with _conversions_lock:
+        _conversion_processes.discard(process)
+        if _conversions_cancelled:
+            raise ConversionCancelled()
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Format a number of seconds as hours, minutes and seconds.
+
+    Args:
+        seconds (float): The number of seconds.
+
+    Returns:
+        str: The duration as HH:MM:SS.ss.
+    """
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return "{:0>2}:{:0>2}:{:05.2f}".format(int(hours), int(minutes), seconds)
+
+
+def run_conversion(stream, file_name: str, original_size: int) -> bool:
+    """
+    Run an ffmpeg conversion, showing its progress and estimated time left as it goes.
+
+    A progress line is printed every CONVERSION_PROGRESS_STEP percent, each on its own
+    line so the ones of other conversions and of the upload don't overwrite it.
+
+    ffmpeg reports its progress on stdout, while its log (where the duration of the
+    input can be read) goes to stderr. Once EARLY_ABORT_PROGRESS of the video has been
+    encoded, if the output is on track to be bigger than EARLY_ABORT_RATIO of the
+    original, the conversion is stopped since it wouldn't save any space worth having.
+
+    Args:
+        stream: The ffmpeg-python output stream to run.
+        file_name (str): The name of the file being converted, for the progress line.
+        original_size (int): The size of the original file in bytes.
+
+    Returns:
+        bool: True if the conversion finished, False if it was given up.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails.
+        ConversionCancelled: If the conversions get cancelled.
+    """
+    process = start_ffmpeg(stream.global_args("-nostats", "-progress", "pipe:1"))
+    # drained on its own thread so a chatty log can never fill the pipe and block ffmpeg
+    log_lines: list = []
+    log_reader = threading.Thread(target=lambda: log_lines.extend(process.stderr))
+    log_reader.start()
+
+    duration: float = None
+    output_size: int = 0
+    encoded_time: float = 0.0
+    start_time: float = time.monotonic()
+    last_percentage: int = -CONVERSION_PROGRESS_STEP
+    finished: bool = True
+    for line in process.stdout:
+        key, _, value = line.decode().strip().partition("=")
+        if key == "total_size" and value.isdigit():
+            output_size = int(value)
+        elif key in ("out_time_us", "out_time_ms") and value.isdigit():
+            # both keys hold microseconds, out_time_ms is the older name
+            encoded_time = int(value) / 1_000_000
+        elif key == "progress":
+            if duration is None:
+                duration_match = DURATION_PATTERN.search(b"".join(log_lines))
+                if duration_match is not None:
+                    hours, minutes, seconds = duration_match.groups()
+                    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            if not duration or not encoded_time:
+                continue
+
+            done: float = min(encoded_time / duration, 1.0)
+            percentage: int = int(done * 100)
+            if percentage >= last_percentage + CONVERSION_PROGRESS_STEP:
+                last_percentage = percentage
+                time_left: float = (time.monotonic() - start_time) * (1 - done) / done
+                # a single write, so lines from other threads can't cut into it
+                sys.stdout.write(
+                    f"\r{file_name}: {percentage}% "
+                    f"(ETA {format_duration(time_left)})\x1b[K\n"
+                )
+                sys.stdout.flush()
+            if (
+                done >= EARLY_ABORT_PROGRESS
+                and output_size / done > EARLY_ABORT_RATIO * original_size
+            ):
+                process.terminate()
+                finished = False
+                break
+
+    process.wait()
+    log_reader.join()
+    finish_ffmpeg(process)
+    if finished and process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", b"".join(log_lines))
+    return finished
+
+
+def get_x265_params(*params: str) -> str:
+    """
+    Build the x265-params option of a libx265 encode, limiting its thread pool.
+
+    For libx265 ffmpeg turns -threads into x265's frame threads, which leaves the pool
+    doing the actual work sized to every core. The pool is sized to this conversion's
+    share of the cores instead, so conversions running side by side split the CPU.
+
+    Args:
+        *params (str): Further x265 parameters, like "pass=1".
+
+    Returns:
+        str: The parameters joined the way x265-params takes them.
+    """
+    pool_threads: int = min(ffmpeg_threads, X265_MAX_POOL_THREADS)
+    return ":".join((f"pools={pool_threads}", *params))
+
+
+def encode_to_H265(
+    origin_file: str, new_file: str, encoder: str, original_size: int
+) -> bool:
+    """
+    Run ffmpeg to encode a file to mp4 with the given H.265 encoder.
+
+    Args:
+        origin_file (str): The original file path.
+        new_file (str): The path of the file to write.
+        encoder (str): The name of the ffmpeg encoder to use.
+        original_size (int): The size of the original file in bytes.
+
+    Returns:
+        bool: True if the file was converted, False if it was given up for not saving
+        enough space.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails.
+        ConversionCancelled: If the conversions get cancelled.
+    """
+    if encoder == SOFTWARE_ENCODER and x265_bitrate:
+        return encode_to_H265_two_pass(origin_file, new_file, original_size)
+
+    input_options, output_options = HARDWARE_ENCODERS.get(encoder, ({}, {"crf": 23}))
+    if encoder == SOFTWARE_ENCODER:
+        output_options = {**output_options, "x265-params": get_x265_params()}
+    else:
+        output_options = {**output_options, "threads": ffmpeg_threads}
+    stream = ffmpeg.input(origin_file, **input_options).output(
+        new_file,
+        vcodec=encoder,
+        acodec="aac",
+        strict="experimental",
+        **output_options,
     )
-    if convert_confirmation.lower() in ["y", "yes"]:
-        new_origin_files = []
-        for full_item in origin_files:
-            for directory, file_names in full_item.items():
-                if file_names:
-                    new_origin_dict = {directory: []}
-                    for file_name in file_names:
-                        new_file_path = convert_to_H265_codec(f"{directory}/{file_name}")
-                        new_file = Path(new_file_path)
-                        new_origin_dict[directory].append(
-                            f"{new_file.stem}{new_file.suffix}"
-                        )
-                    new_origin_files.append(new_origin_dict)
-        origin_files = new_origin_files
-
-    return origin_files
+    return run_conversion(stream, os.path.basename(origin_file), original_size)
 
 
-def convert_to_H265_codec(origin_file: str) -> str:
+def encode_to_H265_two_pass(origin_file: str, new_file: str, original_size: int) -> bool:
     """
-    Convert the given file to mp4 format with H.265 codec.
+    Encode a file with libx265 in two passes at the X265_BITRATE average bitrate.
+
+    The first pass only analyses the video, it writes the x265 statistics and throws the
+    frames away through the null muxer. The second pass uses those statistics to spend
+    the bitrate where the video needs it.
 
     Args:
         origin_file (str): The original file path.
+        new_file (str): The path of the file to write.
+        original_size (int): The size of the original file in bytes.
 
     Returns:
-        str: The path of the converted file if conversion is successful, otherwise the
-        original file path.
+        bool: True if the file was converted, False if it was given up for not saving
+        enough space.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg fails.
+        ConversionCancelled: If the conversions get cancelled.
+    """
+    # x265 writes the stats file plus a .cutree companion, the directory takes both away
+    with tempfile.TemporaryDirectory(prefix="cp2toto-x265-") as stats_folder:
+        stats_file: str = os.path.join(stats_folder, "x265.log")
+        first_pass = start_ffmpeg(
+            ffmpeg.input(origin_file).output(
+                os.devnull,
+                f="null",
+                an=None,
+                vcodec=SOFTWARE_ENCODER,
+                **{
+                    "b:v": x265_bitrate,
+                    "x265-params": get_x265_params("pass=1", f"stats={stats_file}"),
+                },
+            )
+        )
+        _, first_pass_log = first_pass.communicate()
+        finish_ffmpeg(first_pass)
+        if first_pass.returncode != 0:
+            raise ffmpeg.Error("ffmpeg", b"", first_pass_log)
+        stream = ffmpeg.input(origin_file).output(
+            new_file,
+            vcodec=SOFTWARE_ENCODER,
+            acodec="aac",
+            strict="experimental",
+            **{
+                "b:v": x265_bitrate,
+                "x265-params": get_x265_params("pass=2", f"stats={stats_file}"),
+            },
+        )
+        return run_conversion(stream, os.path.basename(origin_file), original_size)
+
+
+def _find_atom(data: bytes, start: int, end: int, *path: bytes) -> tuple:
     """
-    original_size = os.path.getsize(origin_file)
+    Find an atom nested inside a slice of an mp4 file, following a path of atom types.
+
+    Args:
+        data (bytes): The bytes holding the atoms.
+        start (int): The offset where the atoms to search start.
+        end (int): The offset where the atoms to search end.
+        *path (bytes): The types of the atoms to descend into, outermost first.
+
+    Returns:
+        tuple: The offsets where the body of the atom found starts and ends, None if
+        there is no such atom.
+    """
+    for atom_type in path:
+        while start + 8 <= end:
+            size, kind = struct.unpack_from(">I4s", data, start)
+            header_size: int = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", data, start + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - start
+            if size < header_size:
+                return None
+            if kind == atom_type:
+                start, end = start + header_size, min(start + size, end)
+                break
+            start += size
+        else:
+            return None
+    return start, end
+
+
+def mp4_video_codec(origin_file: str) -> str:
+    """
+    Read the codec of the video track of an mp4/mov file straight from its atoms.
+
+    Only the moov atom is read, and the sample description of the video track tells the
+    codec, which saves running ffprobe for the common containers.
+
+    Args:
+        origin_file (str): The file path.
+
+    Returns:
+        str: The codec name as ffprobe reports it, None if it could not be told.
+    """
+    with open(origin_file, "rb") as media_file:
+        while len(header := media_file.read(8)) == 8:
+            size, kind = struct.unpack(">I4s", header)
+            header_size: int = 8
+            if size == 1:
+                size = struct.unpack(">Q", media_file.read(8))[0]
+                header_size = 16
+            if kind == b"moov":
+                moov: bytes = media_file.read(size - header_size if size else -1)
+                break
+            if size < header_size:
+                return None
+            media_file.seek(size - header_size, os.SEEK_CUR)
+        else:
+            return None
+
+    start: int = 0
+    while trak := _find_atom(moov, start, len(moov), b"trak"):
+        trak_start, trak_end = trak
+        start = trak_end
+        hdlr = _find_atom(moov, trak_start, trak_end, b"mdia", b"hdlr")
+        if hdlr is None or moov[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+            continue
+        stsd = _find_atom(moov, trak_start, trak_end, *MP4_SAMPLE_DESCRIPTION)
+        if stsd is None:
+            return None
+        # version/flags and entry count, then the size and format of the first entry
+        return MP4_VIDEO_CODECS.get(moov[stsd[0] + 12 : stsd[0] + 16])
+    return None
+
+
+@lru_cache(maxsize=256)
+def probe_video_codec(origin_file: str, file_id: tuple) -> str:
+    """
+    Find out the codec of the video stream of a file.
+
+    mp4 and mov files are read directly, ffprobe is only run for other containers or
+    when the atoms don't give a codec this tool knows about.
+
+    Args:
+        origin_file (str): The file path.
+        file_id (tuple): The inode, modification time and size of the file, so the cached
+        answer is dropped when the file changes on disk.
+
+    Returns:
+        str: The codec name of the first video stream, None if the file has none.
+    """
+    if origin_file.lower().endswith(MP4_EXTENSIONS):
+        try:
+            video_codec: str = mp4_video_codec(origin_file)
+        except (OSError, struct.error):
+            video_codec = None
+        if video_codec is not None:
+            return video_codec
+
     probe = ffmpeg.probe(origin_file)
     video_stream = next(
         (stream for stream in probe["streams"] if stream["codec_type"] == "video"), None
     )
-    if video_stream is None:
+    return video_stream["codec_name"] if video_stream is not None else None
+
+
+def get_video_codec(origin_file: str, file_stat: os.stat_result) -> str:
+    """
+    Get the codec of the first video stream of a file.
+
+    Args:
+        origin_file (str): The path of the file.
+        file_stat (os.stat_result): The stat of the file, identifying this version of it.
+
+    Returns:
+        str: The name of the codec, or None if the file has no video stream.
+    """
+    if origin_file.endswith(HEVC_SUFFIXES):
+        # named by a previous conversion (or a raw HEVC stream), no need to probe it
+        return "hevc"
+    return probe_video_codec(
+        origin_file, (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    )
+
+
+def print_conversion_plan(source_files: list) -> None:
+    """
+    Print the files that would be converted to mp4 with H.265 codec, and their new names.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+    """
+    print(colored("\nIf converted to H.265 before copying:", "yellow", attrs=["bold"]))
+    for source_file, file_name in source_files:
+        video_codec: str = get_video_codec(source_file, os.stat(source_file))
+        if video_codec is None:
+            print(colored(f" - {file_name} (no video, copied as is)", "cyan"))
+        elif video_codec == "hevc":
+            print(colored(f" - {file_name} (already H.265, copied as is)", "cyan"))
+        else:
+            new_file_name: str = os.path.basename(get_new_file_name(source_file))
+            print(colored(f" - {file_name} -> {new_file_name}", "cyan"))
+
+
+def convert_to_H265_codec(origin_file: str) -> str:
+    """
+    Convert the given file to mp4 format with H.265 codec.
+
+    Args:
+        origin_file (str): The original file path.
+
+    Returns:
+        str: The path of the converted file if conversion is successful, otherwise the
+        original file path.
+
+    Raises:
+        ConversionCancelled: If the conversions get cancelled, the partly converted file
+        is removed first.
+    """
+    file_stat = os.stat(origin_file)
+    original_size = file_stat.st_size
+    video_codec: str = get_video_codec(origin_file, file_stat)
+    if video_codec is None:
         print(f"No video stream found in {colored(origin_file, 'red')}")
         return origin_file
 
-    if video_stream["codec_name"] != "hevc":
+    if video_codec != "hevc":
         new_origin_file = get_new_file_name(origin_file)
+        encoder = get_video_encoder()
         try:
             print(
                 (
                     f"\nConverting {colored(origin_file, 'yellow')}\n"
-                    "to mp4 with H.265 codec"
+                    f"to mp4 with H.265 codec ({encoder})"
                 )
             )
             start_time = time.time()
-            ffmpeg.input(origin_file).output(
-                new_origin_file,
-                vcodec="libx265",
-                crf=23,
-                acodec="aac",
-                strict="experimental",
-            ).overwrite_output().run(quiet=True)
+            try:
+                converted = encode_to_H265(
+                    origin_file, new_origin_file, encoder, original_size
+                )
+            except ffmpeg.Error:
+                if encoder == SOFTWARE_ENCODER:
+                    raise
+                # some inputs (pixel formats, resolutions) are out of reach of the GPU
+                print(colored(f"{encoder} failed, retrying with libx265", "red"))
+                converted = encode_to_H265(
+                    origin_file, new_origin_file, SOFTWARE_ENCODER, original_size
+                )
             end_time = time.time()
 
+        except ConversionCancelled:
+            if os.path.exists(new_origin_file):
+                os.remove(new_origin_file)
+            raise
+
         except ffmpeg.Error as err:
             print(
                 f"Error occurred while converting {colored(origin_file, 'yellow')} to "
@@ -168,14 +808,19 @@ def convert_to_H265_codec(origin_file: str) -> str:
             sys.exit(1)
 
         else:
+            if not converted:
+                if os.path.exists(new_origin_file):
+                    os.remove(new_origin_file)
+                print(
+                    f"{colored(origin_file, 'yellow')} would barely shrink "
+                    f"{colored('(keeping the original)', 'green', attrs=['bold'])}"
+                )
+                return origin_file
+
             new_size = os.path.getsize(new_origin_file)
             size_reduction = int(((original_size - new_size) / original_size) * 100)
             space_saved = format_size(original_size - new_size)
-            hours, rem = divmod(end_time - start_time, 3600)
-            minutes, seconds = divmod(rem, 60)
-            formatted_time = "{:0>2}:{:0>2}:{:05.2f}".format(
-                int(hours), int(minutes), seconds
-            )
+            formatted_time = format_duration(end_time - start_time)
             print(f"Conversion time: {colored(formatted_time, 'white', attrs=['bold'])}")
             print(
                 f"Space saved: {colored(f'{size_reduction}%', 'magenta', attrs=['bold'])}"
@@ -201,79 +846,100 @@ def format_size(size_bytes: float) -> str:
     Returns:
         str: The size in a human-readable format.
     """
-    sizes = ["B", "KB", "MB", "GB", "TB"]
-    for size in sizes:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.2f} {size}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.2f} {sizes[-1]}"
+    # every unit is 2**10 times the previous one, so the bit length of the size picks it
+    unit: int = min(max(int(size_bytes).bit_length() - 1, 0) // 10, len(SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * unit)):.2f} {SIZE_UNITS[unit]}"
 
 
-def collect_file_names(origin_files: list) -> list:
+def collect_file_names(origin_files: list) -> Iterator[tuple]:
     """
     Collect all file names to be copied.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
 
     Returns:
-        list: A list of tuples. Each tuple contains the source file path and the file name
+        Iterator[tuple]: The source file path and the file name, one file at a time.
     """
-    return [
-        (f"{source_folder}/{source_file}", source_file)
-        for full_item in origin_files
-        for source_folder, source_files in full_item.items()
-        for source_file in source_files
-    ]
+    return chain.from_iterable(
+        ((f"{source_folder}/{source_file}", source_file) for source_file in source_files)
+        for source_folder, source_files in origin_files
+    )
 
 
-def remove_local_files(origin_items: list) -> None:
+def get_items_to_remove(origin_items: list) -> list:
     """
-    Remove the local files after they have been copied via scp.
+    Get the local files and folders removed once the files have been copied.
+
+    Files picked straight from the origin folder are removed one by one, while a file
+    picked inside a subfolder takes the whole subfolder with it.
 
     Args:
-        origin_items (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        origin_items (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+
+    Returns:
+        list: A list of tuples. Each tuple contains the resolved path of the item and
+        whether it is a directory.
     """
-    item_paths = []
+    item_paths: list = []
+    for folder, files in origin_items:
+        if folder == origin_folder:
+            for origin_file in files:
+                item_path = Path(folder, origin_file).resolve()
+                item_paths.append((item_path, item_path.is_dir()))
+        else:
+            item_path = Path(folder).resolve()
+            item_paths.append((item_path, item_path.is_dir()))
+    return item_paths
 
-    for full_item in origin_items:
-        for folder, files in full_item.items():
-            if folder == origin_folder:
-                for origin_file in files:
-                    item_paths.append(Path(folder, origin_file).resolve())
-            else:
-                item_paths.append(Path(folder).resolve())
 
+def print_items_to_remove(item_paths: list) -> None:
+    """
+    Print the local files and folders that would be removed.
+
+    Args:
+        item_paths (list): A list of tuples. Each tuple contains the path of the item and
+        whether it is a directory.
+    """
     message = colored("\nFiles to be removed:\n", "red")
     print(message)
-    for item_path in item_paths:
-        is_folder_warning = (
-            colored("(directory)", "cyan") if Path(item_path).is_dir() else ""
-        )
-        message = colored(f" - {item_path} {is_folder_warning}", "red")
-        print(message)
+    for item_path, is_dir in item_paths:
+        print(FILE_TO_REMOVE_LINE.format(item_path, DIRECTORY_TAG if is_dir else ""))
+
+
+def remove_local_files(
+    origin_items: list, confirm: Callable[[str], bool] = ask_yes_no
+) -> None:
+    """
+    Remove the local files after they have been copied via scp.
+
+    Args:
+        origin_items (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        confirm (Callable[[str], bool], optional): Asks a yes/no question and returns
+        the answer. Defaults to ask_yes_no.
+    """
+    # resolve and stat each item once, the listing and the removal below reuse it
+    item_paths: list = get_items_to_remove(origin_items)
+    print_items_to_remove(item_paths)
 
-    remove_local_files: str = input(
+    remove_local_files: bool = confirm(
         colored(
             "\nDo you want to remove the local files? (check paths above) [y/N]: ",
             "yellow",
             attrs=["bold"],
         )
     )
-    if remove_local_files.lower() in ["y", "yes"]:
+    if remove_local_files:
         print()
-        for item_path in item_paths:
-            if Path(item_path).is_dir():
-                shutil.rmtree(Path(item_path).resolve())
+        for item_path, is_dir in item_paths:
+            if is_dir:
+                shutil.rmtree(item_path)
             else:
-                os.remove(Path(item_path).resolve())
+                os.remove(item_path)
 
-            prefix_message = colored("Removed:", "red")
-            message = colored(Path(item_path).resolve(), "cyan")
-            print(f"{prefix_message} {message}")
+            print(FILE_REMOVED_LINE.format(item_path))
     else:
         print("Not removing local files!")
@@ -1,36 +1,121 @@
 import os
+import queue
 import sys
+import threading
+import time
+
+from functools import cache
 
-from pyfiglet import Figlet
 from termcolor import colored
 
 from utils.config import server_name
 from utils.misc import format_size
 
+# Minimum number of seconds between two progress updates for the same file
+PROGRESS_INTERVAL: float = 0.1
+
+# colored fragments that never change, built once instead of on every call
+DONE_ICON: str = colored("􀆅", "green", attrs=["bold"])
+DONE_PADDING: str = " " * 30
+PERCENTAGES: tuple = tuple(colored(f"{i}%", "green", attrs=["bold"]) for i in range(101))
+
+_last_print: dict = {}
+_progress_prefixes: dict = {}
+# progress updates waiting to be drawn by the progress thread
+_progress_queue: queue.Queue = queue.Queue()
+
 
 def print_progress(filename, size, sent) -> None:
     """
-    Display the progress of the SCP file transfer.
+    Display the progress of the file transfer.
+
+    The update is handed to a background thread that does the drawing, so the thread
+    uploading the file goes straight back to sending the next chunk instead of waiting
+    on the terminal. Call wait_for_progress() before printing anything else.
+
+    Args:
+        filename (str): The name of the file being transferred.
+        size (int): The total size of the file being transferred in bytes.
+        sent (int): The number of bytes that have been transferred so far.
+    """
+    _progress_queue.put_nowait((filename, size, sent))
+
+
+def wait_for_progress() -> None:
+    """
+    Wait until every progress update handed to print_progress() has been drawn.
+    """
+    _progress_queue.join()
+
+
+def _drain_progress() -> None:
+    """
+    Draw the progress updates put on the queue by print_progress(), forever.
+    """
+    while True:
+        filename, size, sent = _progress_queue.get()
+        try:
+            draw_progress(filename, size, sent)
+        except Exception as error:
+            # a failed update must not take the thread down, wait_for_progress() would
+            # block forever with nobody left to drain the queue
+            print(colored(f"Could not draw the progress of {filename}: {error}", "red"))
+        finally:
+            _progress_queue.task_done()
+
+
+def draw_progress(filename, size, sent) -> None:
+    """
+    Draw the progress of the file transfer.
 
     This function prints the name of the file being transferred, its size, and the
-    percentage of bytes transferred so far.
+    percentage of bytes transferred so far. Once the whole file has been sent, it prints
+    a final line marking the file as copied.
+
+    Updates arrive for every chunk written, so the line is only redrawn when the
+    percentage changed and at most once every PROGRESS_INTERVAL seconds per file, and the
+    colored file name and size are only built once per file.
 
     Args:
         filename (str): The name of the file being transferred.
         size (int): The total size of the file being transferred in bytes.
         sent (int): The number of bytes that have been transferred so far.
     """
-    filename = colored(
-        f" {filename.decode('utf-8')}",
-        "yellow",
-        attrs=["bold"],
-    )
-    progress = colored(
-        f"{int(float(sent) / float(size) * 100)}%",
-        "green",
-        attrs=["bold"],
-    )
-    print(f"{filename} ({format_size(size)}): {progress} {' ' * 10}\r", end="")
+    # a file that grew while being sent can go past the size taken before the upload
+    done: bool = sent >= size
+    percentage: int = min(sent * 100 // max(size, 1), 100)
+    now: float = time.monotonic()
+    if not done:
+        last_time, last_percentage = _last_print.get(filename, (0, -1))
+        if percentage == last_percentage or now - last_time <= PROGRESS_INTERVAL:
+            return
+    _last_print[filename] = (now, percentage)
+
+    prefix: str = _progress_prefixes.get(filename)
+    if prefix is None:
+        colored_file_name: str = colored(f" {filename}", "yellow", attrs=["bold"])
+        prefix = f"{colored_file_name} ({format_size(size)}): "
+        _progress_prefixes[filename] = prefix
+
+    sys.stdout.write(f"{prefix}{PERCENTAGES[percentage]} {' ' * 10}\r")
+    sys.stdout.flush()
+
+    if done:
+        # the file is done, its throttling state isn't needed anymore
+        _last_print.pop(filename, None)
+        _progress_prefixes.pop(filename, None)
+        print_file_copied(filename)
+
+
+def print_file_copied(filename: str) -> None:
+    """
+    Print a line marking a file as copied.
+
+    Args:
+        filename (str): The name of the file that was copied.
+    """
+    file_msg: str = colored(filename, "cyan", attrs=["bold"])
+    print(f"{file_msg} {DONE_ICON} {DONE_PADDING}")
 
 
 def bye(goodbye_msg="\nFarewell!\n") -> None:
@@ -49,6 +134,36 @@ def bye(goodbye_msg="\nFarewell!\n") -> None:
     sys.exit(0)
 
 
+def clear_screen() -> None:
+    """
+    Clear the terminal screen and its scrollback.
+
+    The ANSI escape sequence is written directly instead of running the clear command,
+    except on Windows consoles that may not understand it.
+    """
+    if sys.platform == "win32":
+        os.system("cls")
+        return
+    sys.stdout.write("\x1b[H\x1b[2J\x1b[3J")
+    sys.stdout.flush()
+
+
+@cache
+def banner() -> str:
+    """
+    Render the welcome banner, only once per run.
+
+    Returns:
+        str: The colored banner.
+    """
+    # pyfiglet loads its font database on import, so it is only imported when needed
+    from pyfiglet import Figlet
+
+    # lean isometric poison alligator
+    fig: Figlet = Figlet(font="larry3d")
+    return colored(fig.renderText(" CP2TOTO "), "cyan")
+
+
 def welcome() -> None:
     """
     Display a welcome message and banner.
@@ -57,11 +172,8 @@ def welcome() -> None:
     instructing the user on how to select files/folders for copying. The banner is
     generated using the 'larry3d' font from the pyfiglet library.
     """
-    os.system("clear")
-    # lean isometric poison alligator
-    fig: Figlet = Figlet(font="larry3d")
-    banner: str = colored(fig.renderText(" CP2TOTO "), "cyan")
-    print(banner)
+    clear_screen()
+    print(banner())
 
     welcome_text: str = colored(
         (
@@ -73,3 +185,7 @@ def welcome() -> None:
     )
     print(welcome_text)
     print("-" * 90)
+
+
+# drawing the progress of the transfers, started once everything above is defined
+threading.Thread(target=_drain_progress, daemon=True).start()
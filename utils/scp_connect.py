@@ -1,4 +1,6 @@
-from utils.misc import confirmation_flow
+from collections.abc import Callable
+
+from utils.misc import ask_yes_no, collect_file_names, confirmation_flow
 from utils.ssh_operations import (
     check_files,
     check_space,
@@ -8,36 +10,53 @@ from utils.ssh_operations import (
 )
 
 
-def scp(origin_files: list, destination_folder: str) -> None:
+def scp(
+    origin_files: list,
+    destination_folder: str,
+    convert: bool = False,
+    confirm: Callable[[str], bool] = ask_yes_no,
+) -> list:
     """
     Securely copy files from the local system to a remote server using SCP.
 
     This function performs the following steps:
-    1. Clears the terminal screen and asks the user if they want to convert the files to
-       mp4 with H.265 codec before copying.
-    2. If the user confirms, the conversion is performed and the list of origin files is
-       updated.
-    3. The function then prompts the user to confirm the file transfer. If the user
-       confirms, the SCP transfer is initiated with a progress bar.
-    4. After the transfer is complete, the function sets the permissions of the files on
+    1. Prompts the user to confirm the file transfer.
+    2. If the user confirms, the transfer is initiated with a progress bar. When the files
+       have to be converted to mp4 with H.265 codec, each file is uploaded as soon as
+       its conversion is done and the list of origin files is updated.
+    3. After the transfer is complete, the function sets the permissions of the files on
        the server, checks if the files have been transferred correctly, and checks the
-       available space on the server.
+       available space on the server, all over the same pooled SSH connection used for
+       the transfer.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
         destination_folder (str): The path to the destination folder on the server.
+        convert (bool, optional): Whether to convert the files to mp4 with H.265 codec
+        before copying them. Defaults to False.
+        confirm (Callable[[str], bool], optional): Asks the copy and renaming yes/no
+        questions and returns the answer. Defaults to ask_yes_no.
+
+    Returns:
+        list: The list of origin files that were copied, after conversion, or None if the
+        user didn't confirm the transfer.
 
     Raises:
         Exception: If there is an error with the SSH connection.
     """
-    if confirmation_flow(origin_files, destination_folder):
-        establish_ssh_and_scp(origin_files, destination_folder)
+    # flatten the selection once, every step below works on the same list
+    source_files: list = list(collect_file_names(origin_files))
+    if confirmation_flow(source_files, destination_folder, confirm):
+        origin_files = establish_ssh_and_scp(
+            origin_files, source_files, destination_folder, convert
+        )
+        if convert:
+            source_files = list(collect_file_names(origin_files))
         set_permissions(destination_folder)
-        check_files(origin_files, destination_folder)
+        check_files(source_files, destination_folder)
         check_space()
         # only rename files if we are copying to the series folder
         if "series" in destination_folder:
-            rename_files(origin_files, destination_folder)
-        return True
+            rename_files(origin_files, destination_folder, confirm)
+        return origin_files
@@ -1,66 +1,811 @@
+import asyncio
+import atexit
+import math
 import os
+import posixpath
 import re
+import shlex
+import shutil
+import socket
+import statistics
 import subprocess
 import sys
+import tempfile
+import threading
 
-from paramiko import SSHClient
-from scp import SCPClient
+from collections.abc import Callable
+from functools import cache
+
+from paramiko import SFTPClient, SSHClient, Transport
 from termcolor import colored
 
-from utils.config import base_folder, destination_base_folder, server_name, server_user
-from utils.output import bye, print_progress
+from utils.config import (
+    base_folder,
+    conversion_workers,
+    destination_base_folder,
+    max_ssh_connections,
+    server_name,
+    server_user,
+    sftp_channels,
+    ssh_compression,
+    ssh_target,
+    transfer_backend,
+    transfer_bdp_bytes,
+)
+from utils.misc import (
+    ask_yes_no,
+    cancel_conversions,
+    convert_files,
+    format_size,
+    get_file_size,
+    update_file_names,
+)
+from utils.output import bye, print_file_copied, print_progress, wait_for_progress
+
+# Chunk size used when reading local files and writing them over SFTP
+SFTP_CHUNK_SIZE: int = 1024 * 1024
+# SSH window size for the transfer channel, large enough to keep the link busy
+SFTP_WINDOW_SIZE: int = 2**27
+# Bytes transferred before paramiko renegotiates the session keys
+SFTP_REKEY_BYTES: int = pow(2, 40)
+# Kernel send buffer of the pooled SSH sockets, large enough for a long fat link
+SSH_SOCKET_SNDBUF: int = 4 * 1024 * 1024
+# Seconds the master connection stays open when idle, it is closed at exit anyway
+SSH_CONTROL_PERSIST: int = 600
+# Selections with more files than this, and a median size below TAR_MAX_MEDIAN_SIZE,
+# are streamed as a single tar archive instead of file by file
+TAR_MIN_FILES: int = 8
+TAR_MAX_MEDIAN_SIZE: int = 16 * 1024 * 1024
+# First rsync release with -s (--protect-args), which sends the destination path to the
+# server without going through its shell
+RSYNC_PROTECT_ARGS_VERSION: tuple = (3, 0)
+# First OpenSSH release whose scp talks SFTP by default, older ones use the legacy
+# protocol, which hands the destination path to the server's shell
+SCP_SFTP_PROTOCOL_VERSION: tuple = (9, 0)
+# Ciphers offered first by the pooled connections, AES-128 costs the least CPU per MB
+# transferred. The rest stay offered after them, for servers without these
+SSH_PREFERRED_CIPHERS: tuple = ("aes128-ctr",)
+# Cipher preference of the OpenSSH master connection, AES-GCM runs on the CPU's AES
+# instructions and needs no separate MAC pass
+SSH_CIPHERS: str = "aes128-gcm@openssh.com,aes256-gcm@openssh.com,aes128-ctr"
+# Converted files allowed to wait for the upload before conversions are held back
+UPLOAD_BACKLOG: int = 2
+# Season number in a season folder name and episode number in a file name
+SEASON_PATTERN: re.Pattern = re.compile(r"(?:S|season)(\d+)", re.IGNORECASE)
+EPISODE_PATTERN: re.Pattern = re.compile(r"E(\d+)", re.IGNORECASE)
+# Maximum number of paths listed by a single remote ls when checking files
+CHECK_FILES_BATCH_SIZE: int = 70
+
+# Open SSH connections, keyed by (user, host, slot), kept alive for the whole run
+_pool: dict[tuple, SSHClient] = {}
+# One lock per pool key, so threads sharing a slot don't both open its connection
+_pool_locks: dict[tuple, threading.Lock] = {}
+# Private directory holding the control socket shared by every ssh/scp process of this
+# run, so no other local user can put a socket of their own in its place. Made by the
+# first start_ssh_control_master(), runs that never need the master leave nothing behind
+_control_folder: str = None
+
+
+def close_ssh_connections() -> None:
+    """
+    Closes every SSH connection in the pool.
+    """
+    for ssh in _pool.values():
+        ssh.close()
+    _pool.clear()
+
+
+atexit.register(close_ssh_connections)
+
+
+def make_transport(*args, **kwargs) -> Transport:
+    """
+    Creates the transport of a pooled connection, offering SSH_PREFERRED_CIPHERS first.
+
+    The server picks the first cipher of the client's list it supports, so putting them
+    first makes them win without dropping the others for servers that don't have them.
+
+    Returns:
+        Transport: The transport, not connected yet.
+    """
+    transport = Transport(*args, **kwargs)
+    security_options = transport.get_security_options()
+    security_options.ciphers = SSH_PREFERRED_CIPHERS + tuple(
+        cipher
+        for cipher in security_options.ciphers
+        if cipher not in SSH_PREFERRED_CIPHERS
+    )
+    return transport
 
 
-def collect_file_names(origin_files: list) -> list:
+def get_ssh(user: str = server_user, host: str = server_name, slot: int = 0) -> SSHClient:
     """
-    Collects all file names to be copied from the local system to the remote server.
+    Returns a connected SSH client for the given user and host.
+
+    Connections are cached for the lifetime of the process, so the transfer and all the
+    remote commands run afterwards share a single handshake. If the cached connection
+    is no longer active, a new one is opened in its place. Transfers that want several
+    connections to the same server at once ask for different slots.
+
+    The connection prefers AES-128 and is only compressed when SSH_COMPRESSION is
+    enabled, since the media files copied by this tool are already compressed.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        user (str): The user to connect as. Defaults to server_user.
+        host (str): The server to connect to. Defaults to server_name.
+        slot (int): The index of the connection to the server. Defaults to 0.
 
     Returns:
-        list: A list of tuples. Each tuple contains the source file path and the file name
+        SSHClient: The connected SSH client.
     """
-    return [
-        (f"{origin_folder}/{origin_file}", origin_file)
-        for full_item in origin_files
-        for origin_folder, origin_files in full_item.items()
-        for origin_file in origin_files
-    ]
+    with _pool_locks.setdefault((user, host, slot), threading.Lock()):
+        ssh: SSHClient = _pool.get((user, host, slot))
+        if ssh is not None:
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                return ssh
+            ssh.close()
+
+        ssh = SSHClient()
+        ssh.load_system_host_keys()
+        ssh.connect(
+            host,
+            username=user,
+            compress=ssh_compression,
+            transport_factory=make_transport,
+        )
+
+        transport = ssh.get_transport()
+        transport.default_window_size = SFTP_WINDOW_SIZE
+        transport.packetizer.REKEY_BYTES = SFTP_REKEY_BYTES
+        # pipelined writes are many small packets, send them right away and let the
+        # kernel queue enough of them to keep a long link busy
+        sock = transport.sock
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SSH_SOCKET_SNDBUF)
+
+        _pool[(user, host, slot)] = ssh
+        return ssh
+
+
+def ssh_control_options() -> list:
+    """
+    Builds the ssh options that point at the control socket of this run.
+
+    Returns:
+        list: The ssh options.
+    """
+    return ["-o", f"ControlPath={os.path.join(_control_folder, 'ssh.sock')}"]
+
+
+def start_ssh_control_master() -> list:
+    """
+    Starts an OpenSSH master connection in the background, unless one is already up.
+
+    Every ssh and scp process started afterwards with the options returned is
+    multiplexed over this connection, skipping the TCP and SSH handshakes.
+
+    Returns:
+        list: The ssh options that point at the master connection.
+    """
+    global _control_folder
+    if _control_folder is None:
+        _control_folder = tempfile.mkdtemp(prefix="cp2toto-")
+    else:
+        check = subprocess.run(
+            ["ssh", *ssh_control_options(), "-O", "check", ssh_target],
+            capture_output=True,
+        )
+        if check.returncode == 0:
+            return ssh_control_options()
+
+    subprocess.run(
+        [
+            "ssh",
+            "-o",
+            "ControlMaster=yes",
+            "-o",
+            f"ControlPersist={SSH_CONTROL_PERSIST}",
+            *ssh_control_options(),
+            "-c",
+            SSH_CIPHERS,
+            "-N",
+            "-f",
+            ssh_target,
+        ],
+        check=True,
+    )
+    return ssh_control_options()
+
+
+def stop_ssh_control_master() -> None:
+    """
+    Closes the OpenSSH master connection of this run, if there is one, and removes the
+    directory of its control socket.
+    """
+    if _control_folder is None:
+        return
+    subprocess.run(
+        ["ssh", *ssh_control_options(), "-O", "exit", ssh_target], capture_output=True
+    )
+    shutil.rmtree(_control_folder, ignore_errors=True)
+
+
+atexit.register(stop_ssh_control_master)
+
+
+def ssh_command(*remote_command: str) -> list:
+    """
+    Builds the arguments to run a command on the server through the master connection,
+    starting the master first if needed.
+
+    Args:
+        *remote_command (str): The command to run on the server.
+
+    Returns:
+        list: The full ssh command line.
+    """
+    return ["ssh", *start_ssh_control_master(), ssh_target, *remote_command]
+
+
+def sftp_put(sftp: SFTPClient, source_file: str, remote_path: str) -> None:
+    """
+    Uploads a single file over SFTP using pipelined writes.
+
+    With pipelining enabled paramiko doesn't wait for the server to acknowledge each
+    write before sending the next one, so the transfer is no longer bound by the round
+    trip time of the link. The remote copy gets the modification time of the local file,
+    so a later run can tell it is already up to date.
+
+    Args:
+        sftp (SFTPClient): The open SFTP client.
+        source_file (str): The path of the local file.
+        remote_path (str): The full path of the file on the server.
+    """
+    file_name: str = os.path.basename(source_file)
+    stat: os.stat_result = os.stat(source_file)
+    size: int = stat.st_size
+    sent: int = 0
+    with open(source_file, "rb") as local_file, sftp.file(remote_path, "wb") as remote:
+        remote.set_pipelined(True)
+        while chunk := local_file.read(SFTP_CHUNK_SIZE):
+            remote.write(chunk)
+            sent += len(chunk)
+            print_progress(file_name, size, sent)
+    sftp.utime(remote_path, (stat.st_atime, stat.st_mtime))
+
+    if size == 0:
+        print_progress(file_name, 1, 1)
+
+
+def sftp_put_range(
+    slot: int,
+    source_file: str,
+    remote_path: str,
+    offset: int,
+    length: int,
+    report_progress,
+) -> None:
+    """
+    Uploads a byte range of a file over its own SSH connection.
+
+    The remote file must already exist, each range is written in place at its offset.
+
+    Args:
+        slot (int): The pool slot of the SSH connection to use.
+        source_file (str): The path of the local file.
+        remote_path (str): The full path of the file on the server.
+        offset (int): The position of the first byte of the range.
+        length (int): The number of bytes in the range.
+        report_progress (callable): Called with the size of every chunk written.
+    """
+    with (
+        get_ssh(slot=slot).open_sftp() as sftp,
+        open(source_file, "rb") as local_file,
+        sftp.file(remote_path, "r+b") as remote,
+    ):
+        remote.set_pipelined(True)
+        local_file.seek(offset)
+        remote.seek(offset)
+        remaining: int = length
+        while remaining > 0:
+            chunk: bytes = local_file.read(min(SFTP_CHUNK_SIZE, remaining))
+            remote.write(chunk)
+            remaining -= len(chunk)
+            report_progress(len(chunk))
+
+
+async def sftp_put_parallel(
+    source_file: str, remote_path: str, size: int, streams: int
+) -> None:
+    """
+    Uploads a single large file splitting it in ranges written by parallel streams.
+
+    Each stream uses its own SSH connection, so the transfer isn't limited by the window
+    of a single connection. Once every range is written, the remote copy gets the
+    modification time of the local file.
+
+    Args:
+        source_file (str): The path of the local file.
+        remote_path (str): The full path of the file on the server.
+        size (int): The size of the file in bytes.
+        streams (int): The number of parallel streams to use.
+    """
+    file_name: str = os.path.basename(source_file)
+    lock = threading.Lock()
+    sent: int = 0
+
+    def report_progress(chunk_size: int) -> None:
+        nonlocal sent
+        with lock:
+            sent += chunk_size
+            print_progress(file_name, size, sent)
+
+    with get_ssh().open_sftp() as sftp, sftp.file(remote_path, "wb") as remote:
+        remote.truncate(size)
+
+    range_size: int = math.ceil(size / streams)
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(
+                sftp_put_range,
+                slot,
+                source_file,
+                remote_path,
+                offset,
+                min(range_size, size - offset),
+                report_progress,
+            )
+            for slot, offset in enumerate(range(0, size, range_size))
+        )
+    )
+
+    stat: os.stat_result = os.stat(source_file)
+    with get_ssh().open_sftp() as sftp:
+        sftp.utime(remote_path, (stat.st_atime, stat.st_mtime))
 
 
-def establish_ssh_and_scp(origin_files: list, destination_folder: str) -> None:
+async def upload_files(source_files: list, destination_folder: str) -> None:
     """
-    Establishes an SSH connection and initiates an SCP transfer.
+    Uploads the files tuning the number of connections and streams to their sizes.
 
-    This function establishes an SSH connection to the remote server and initiates an SCP
-    transfer of the specified files from the local system to the remote server.
+    Files smaller than the bandwidth-delay product of the link can't keep it busy on
+    their own, so they are spread round-robin over several SFTP channels uploading at
+    the same time, SFTP_CHANNELS on each pooled connection. Larger files are uploaded
+    one after another, each of them split into parallel streams.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+    """
+    small_files: list = []
+    large_files: list = []
+    for source_file, file_name in source_files:
+        size: int = os.path.getsize(source_file)
+        remote_path: str = posixpath.join(destination_folder, file_name)
+        if size < transfer_bdp_bytes:
+            small_files.append((source_file, remote_path))
+        else:
+            large_files.append((source_file, remote_path, size))
+
+    def upload_round_robin(slot: int, files: list) -> None:
+        # every worker has its own SFTP channel, several of them share a connection
+        with get_ssh(slot=slot % max_ssh_connections).open_sftp() as sftp:
+            for source_file, remote_path in files:
+                sftp_put(sftp, source_file, remote_path)
+
+    concurrency: int = min(len(small_files), max_ssh_connections * sftp_channels)
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(upload_round_robin, slot, small_files[slot::concurrency])
+            for slot in range(concurrency)
+        )
+    )
+
+    for source_file, remote_path, size in large_files:
+        streams: int = min(
+            math.ceil(transfer_bdp_bytes / SFTP_CHUNK_SIZE),
+            math.ceil(size / SFTP_CHUNK_SIZE),
+            max_ssh_connections,
+        )
+        await sftp_put_parallel(source_file, remote_path, size, streams)
+
+
+@cache
+def get_openssh_version() -> tuple:
+    """
+    Gets the version of the local OpenSSH client, which scp is part of.
+
+    Returns:
+        tuple: The major and minor version numbers, (0, 0) if they can't be read.
+    """
+    # ssh -V writes something like "OpenSSH_9.2p1 Debian-2+deb12u7, ..." to stderr
+    output: str = subprocess.run(["ssh", "-V"], capture_output=True, text=True).stderr
+    version_match = re.search(r"OpenSSH_(\d+)\.(\d+)", output)
+    if version_match is None:
+        return (0, 0)
+    return int(version_match.group(1)), int(version_match.group(2))
+
+
+def scp_upload(source_files: list, destination_folder: str) -> None:
+    """
+    Uploads the files with a single run of the OpenSSH scp binary.
+
+    OpenSSH does the encryption in C, with AES-GCM on the CPU's AES instructions, which
+    is considerably faster than paramiko's pure Python transport, and the run goes over
+    the shared master connection. Clients older than OpenSSH 9.0 get the destination
+    quoted, since their scp passes it through the server's shell.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
         destination_folder (str): The path to the destination folder on the server.
 
+    Raises:
+        subprocess.CalledProcessError: If scp fails.
+    """
+    if get_openssh_version() >= SCP_SFTP_PROTOCOL_VERSION:
+        remote_folder: str = destination_folder
+    else:
+        # the legacy protocol goes through the remote shell, which splits it on spaces
+        remote_folder: str = shlex.quote(destination_folder)
+
+    control_options: list = start_ssh_control_master()
+    subprocess.run(
+        [
+            "scp",
+            # keep the modification times, so a later run can skip unchanged files
+            "-p",
+            *control_options,
+            *(source_file for source_file, _ in source_files),
+            f"{ssh_target}:{remote_folder}",
+        ],
+        check=True,
+    )
+
+
+@cache
+def get_rsync_version() -> tuple:
+    """
+    Gets the version of the local rsync binary.
+
+    Returns:
+        tuple: The major and minor version numbers, (0, 0) if they can't be read.
+    """
+    output: str = subprocess.run(
+        ["rsync", "--version"], capture_output=True, text=True
+    ).stdout
+    # "rsync  version 3.2.7  protocol version 31", or "rsync version 2.6.9 compatible"
+    # for the openrsync shipped with recent macOS
+    version_match = re.search(r"version (\d+)\.(\d+)", output)
+    if version_match is None:
+        return (0, 0)
+    return int(version_match.group(1)), int(version_match.group(2))
+
+
+def rsync_upload(source_files: list, destination_folder: str) -> None:
+    """
+    Uploads the files with a single run of the rsync binary over the master connection.
+
+    Like scp, rsync leaves the encryption to OpenSSH, and it also keeps partially sent
+    files so an interrupted upload picks up where it stopped when run again. When rsync
+    is missing on either side, the upload is handed to scp instead.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+
+    Raises:
+        subprocess.CalledProcessError: If rsync fails.
+    """
+    if shutil.which("rsync") is None or not server_has_command("rsync"):
+        scp_upload(source_files, destination_folder)
+        return
+
+    if get_rsync_version() >= RSYNC_PROTECT_ARGS_VERSION:
+        remote_options: list = ["-s"]
+        remote_folder: str = destination_folder
+    else:
+        # older releases hand the path to the remote shell, which splits it on spaces
+        remote_options: list = []
+        remote_folder: str = shlex.quote(destination_folder)
+
+    control_options: list = start_ssh_control_master()
+    subprocess.run(
+        [
+            "rsync",
+            "-a",
+            "--partial",
+            # --info=progress2 is missing from the old rsync shipped with macOS
+            "--progress",
+            *remote_options,
+            "-e",
+            shlex.join(["ssh", *control_options]),
+            *(source_file for source_file, _ in source_files),
+            f"{ssh_target}:{remote_folder}",
+        ],
+        check=True,
+    )
+
+
+def list_remote_files(destination_folder: str) -> dict:
+    """
+    Lists the size and modification time of the files in a folder of the server.
+
+    With TRANSFER_BACKEND set to "scp" the folder is listed through the OpenSSH master
+    connection, like the upload itself, and over SFTP on the pooled paramiko connection
+    otherwise.
+
+    Args:
+        destination_folder (str): The path to the folder on the server.
+
+    Returns:
+        dict: The size and the modification time in whole seconds of each file, keyed by
+        file name. Empty if the folder doesn't exist.
+    """
+    if transfer_backend != "scp":
+        try:
+            with get_ssh().open_sftp() as sftp:
+                return {
+                    attributes.filename: (attributes.st_size, attributes.st_mtime)
+                    for attributes in sftp.listdir_attr(destination_folder)
+                }
+        except FileNotFoundError:
+            return {}
+
+    # GNU stat first, BSD stat otherwise, one "size mtime name" line per file
+    listing: str = subprocess.run(
+        ssh_command(
+            f"cd {shlex.quote(destination_folder)} && "
+            "{ stat -c '%s %Y %n' -- * 2>/dev/null || stat -f '%z %m %N' -- *; }"
+        ),
+        capture_output=True,
+        text=True,
+    ).stdout
+    remote_files: dict = {}
+    for line in listing.splitlines():
+        size, _, rest = line.partition(" ")
+        mtime, _, file_name = rest.partition(" ")
+        if size.isdigit() and mtime.isdigit() and file_name:
+            remote_files[file_name] = (int(size), int(mtime))
+    return remote_files
+
+
+def skip_unchanged_files(source_files: list, destination_folder: str) -> list:
+    """
+    Leaves out the files already on the server with the same size and modification time.
+
+    The destination folder is listed once, so checking the files costs a single round
+    trip however many there are. This makes running the tool again after an interrupted
+    copy only upload what is missing.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+
+    Returns:
+        list: The tuples of the files that still have to be uploaded.
+    """
+    remote_files: dict = list_remote_files(destination_folder)
+    pending_files: list = []
+    for source_file, file_name in source_files:
+        stat: os.stat_result = os.stat(source_file)
+        if remote_files.get(file_name) == (stat.st_size, int(stat.st_mtime)):
+            print(colored(f"{file_name} is already on the server, skipping", "yellow"))
+        else:
+            pending_files.append((source_file, file_name))
+    return pending_files
+
+
+def should_stream_with_tar(source_files: list) -> bool:
+    """
+    Tells whether the files are better sent as a single tar stream.
+
+    That is the case for many small files, where uploading them one by one is dominated
+    by the per-file round trips rather than by the data itself.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+
+    Returns:
+        bool: True if the files should be streamed with tar, False otherwise.
+    """
+    if len(source_files) <= TAR_MIN_FILES:
+        return False
+    sizes: list = [get_file_size(source_file) for source_file, _ in source_files]
+    return statistics.median(sizes) < TAR_MAX_MEDIAN_SIZE
+
+
+@cache
+def server_has_command(command: str) -> bool:
+    """
+    Tells whether a command is available on the server.
+
+    Args:
+        command (str): The name of the command, like tar or rsync.
+
+    Returns:
+        bool: True if the command is on the server's PATH, False otherwise.
+    """
+    # asked through the master connection, since only the uploads that run over OpenSSH
+    # need to know, and they shouldn't depend on a paramiko login as well
+    check = subprocess.run(
+        ssh_command(f"command -v {shlex.quote(command)}"), capture_output=True
+    )
+    return check.returncode == 0
+
+
+def tar_upload(source_files: list, destination_folder: str) -> None:
+    """
+    Uploads the files piping a local tar archive into a remote tar over ssh.
+
+    All the files travel through one connection as one continuous stream, which avoids
+    paying the protocol round trips of each file separately. Files are added relative to
+    their folder, each folder being its own -C segment, so they end up directly inside
+    the destination folder. Each file is reported as tar adds it to the stream.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+
+    Raises:
+        Exception: If either the local or the remote tar fails.
+    """
+    tar_command: list = ["tar", "-cvf", "-"]
+    current_folder: str = None
+    for source_file, file_name in source_files:
+        folder: str = os.path.dirname(source_file)
+        if folder != current_folder:
+            tar_command += ["-C", folder]
+            current_folder = folder
+        tar_command.append(file_name)
+
+    # the master connection is brought up before tar starts writing
+    untar_command: list = ssh_command(f"tar -C {shlex.quote(destination_folder)} -xf -")
+    tar = subprocess.Popen(
+        tar_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        # keep macOS' bsdtar from adding AppleDouble "._" files to the archive
+        env={**os.environ, "COPYFILE_DISABLE": "1"},
+    )
+    ssh = subprocess.Popen(untar_command, stdin=tar.stdout)
+    # let tar get a SIGPIPE if ssh exits early
+    tar.stdout.close()
+
+    # with the archive going to stdout, tar lists each file on stderr as it adds it
+    # (bsdtar prefixes the names with "a "), which doubles as progress report
+    for line in tar.stderr:
+        line = line.rstrip("\n")
+        if line.startswith("tar:"):
+            print(colored(line, "red"))
+        else:
+            print_file_copied(line.removeprefix("a "))
+
+    ssh.wait()
+    tar.wait()
+    if tar.returncode or ssh.returncode:
+        raise Exception("The tar stream to the server failed")
+
+
+async def convert_and_upload(
+    origin_files: list, source_files: list, destination_folder: str
+) -> list:
+    """
+    Converts the files to mp4 with H.265 codec and uploads them as they are converted.
+
+    The conversions act as a producer, putting each finished file on a queue, while the
+    upload consumes that queue over a single SFTP session. This way the network is busy
+    uploading one file while the next one is still being encoded. No new conversion
+    starts while UPLOAD_BACKLOG converted files are already waiting for the upload, so a
+    slow link doesn't fill the disk with encoded copies. If either side fails, the
+    running conversions are stopped.
+
+    The converted files are always uploaded over SFTP, whatever TRANSFER_BACKEND says,
+    and they are never skipped as unchanged, since each one is a new file.
+
+    Args:
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        source_files (list): The same files as a list of tuples. Each tuple contains the
+        source file path and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+
+    Returns:
+        list: The updated list of origin files after conversion.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=UPLOAD_BACKLOG)
+    # one slot per file being converted, waiting on the queue or being uploaded
+    backlog = asyncio.Semaphore(conversion_workers + UPLOAD_BACKLOG)
+    new_file_paths: dict = {}
+
+    async def convert() -> None:
+        file_paths: list = [source_file for source_file, _ in source_files]
+        async for file_path, new_file_path in convert_files(file_paths, backlog):
+            new_file_paths[file_path] = new_file_path
+            await queue.put(new_file_path)
+        await queue.put(None)
+
+    async def upload() -> None:
+        with get_ssh().open_sftp() as sftp:
+            while (source_file := await queue.get()) is not None:
+                remote_path: str = posixpath.join(
+                    destination_folder, os.path.basename(source_file)
+                )
+                await asyncio.to_thread(sftp_put, sftp, source_file, remote_path)
+                backlog.release()
+
+    try:
+        await asyncio.gather(convert(), upload())
+    except BaseException:
+        # asyncio.run() would otherwise wait for the encodes running in worker threads
+        # to finish before letting the error through, which can take hours
+        cancel_conversions()
+        raise
+    return update_file_names(origin_files, new_file_paths)
+
+
+def establish_ssh_and_scp(
+    origin_files: list,
+    source_files: list,
+    destination_folder: str,
+    convert: bool = False,
+) -> list:
+    """
+    Establishes an SSH connection and initiates an SFTP transfer.
+
+    This function gets connections to the remote server from the pool and uploads the
+    specified files from the local system to the remote server over SFTP, using as many
+    connections and streams as their sizes call for. Many small files are streamed as a
+    single tar archive instead, as long as the server has tar, and with TRANSFER_BACKEND
+    set to "scp" or "rsync" the upload is handed to that binary. Files already on the
+    server with the same size and modification time are not uploaded again. The
+    connections stay open so the post-transfer steps can reuse them.
+
+    If the files have to be converted to mp4 with H.265 codec first, each file is
+    uploaded over SFTP as soon as its conversion finishes. TRANSFER_BACKEND and the
+    skipping of unchanged files don't apply to those uploads.
+
+    Args:
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        source_files (list): The same files as a list of tuples. Each tuple contains the
+        source file path and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+        convert (bool, optional): Whether to convert the files before uploading them.
+        Defaults to False.
+
+    Returns:
+        list: The list of origin files that were copied, after conversion.
+
     Raises:
         Exception: If there is an error with the SSH connection.
     """
     print(colored("Copying...", "green", attrs=["bold"]))
     try:
-        with SSHClient() as ssh:
-            ssh.load_system_host_keys()
-            ssh.connect(server_name)
-            with SCPClient(ssh.get_transport(), progress=print_progress) as scp:
-                source_files: list = collect_file_names(origin_files)
-
-                # Copy files to the destination folder with progress bar
-                for source_file, file_name in source_files:
-                    scp.put(source_file, remote_path=destination_folder)
-                    file_msg: str = colored(f"{file_name}", "cyan", attrs=["bold"])
-                    icon: str = colored("􀆅", "green", attrs=["bold"])
-                    print(f"{file_msg} {icon} {' ' * 30}")
+        if convert:
+            origin_files = asyncio.run(
+                convert_and_upload(origin_files, source_files, destination_folder)
+            )
+        elif transfer_backend == "rsync":
+            # rsync leaves out the files that didn't change on its own
+            rsync_upload(source_files, destination_folder)
+        elif pending_files := skip_unchanged_files(source_files, destination_folder):
+            if transfer_backend == "scp":
+                scp_upload(pending_files, destination_folder)
+            elif should_stream_with_tar(pending_files) and server_has_command("tar"):
+                tar_upload(pending_files, destination_folder)
+            else:
+                asyncio.run(upload_files(pending_files, destination_folder))
+        # let the progress thread catch up before anything else is printed
+        wait_for_progress()
+        return origin_files
 
     except Exception as ssh_error:
         print(
@@ -74,6 +819,28 @@ def establish_ssh_and_scp(origin_files: list, destination_folder: str) -> None:
         raise Exception(f"An error occurred with the ssh connection: {ssh_error}")
 
 
+def run_remote_command(command: str) -> str:
+    """
+    Runs a command on the remote server over the pooled SSH connection.
+
+    Anything the command writes to stderr is printed to the console, the same way it
+    would be when running it through the ssh binary.
+
+    Args:
+        command (str): The shell command to run on the server.
+
+    Returns:
+        str: The standard output of the command.
+    """
+    _, stdout, stderr = get_ssh().exec_command(command)
+    output: str = stdout.read().decode("utf-8")
+    error_output: str = stderr.read().decode("utf-8")
+    stdout.channel.recv_exit_status()
+    if error_output:
+        print(colored(error_output, "red"), end="")
+    return output
+
+
 def set_permissions(destination_folder: str) -> None:
     """
     Sets permissions on copied files.
@@ -83,48 +850,30 @@ def set_permissions(destination_folder: str) -> None:
 
     Args:
         destination_folder (str): The path to the destination folder on the server.
-
-    Raises:
-        subprocess.CalledProcessError: If the subprocess call to ssh fails.
     """
     print(colored("\nSetting permissions on copied files...", "red", attrs=["bold"]))
-    subprocess.run(
-        ["ssh", f"{server_user}@{server_name}", f'chmod -R 755 "{destination_folder}"']
-    )
+    run_remote_command(f'chmod -R 755 "{destination_folder}"')
 
 
-def rename_files(origin_files: list, destination_folder: str) -> None:
+def get_season(destination_folder: str) -> tuple:
     """
-    Renames files in the destination folder on the server based on a specific pattern.
+    Infers the serie name and the season number from the destination folder.
 
-    This function prompts the user for confirmation, performs a dry-run to display the
-    proposed new file names, and if the user confirms, it renames the files.
+    The destination is expected to be a season folder, like ".../Serie/Season 1/".
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
         destination_folder (str): The path to the destination folder on the server.
 
-    Raises:
-        Exception: If there is an error with the SSH connection or command execution.
+    Returns:
+        tuple: The serie name and the zero padded season number, or None if the season
+        number could not be inferred.
     """
-    rename_confirmation: str = input(
-        colored("Do you want to rename the files? [y/N]: ", "yellow", attrs=["bold"])
-    )
-    if rename_confirmation.lower() not in ["y", "yes"]:
-        return
-    print()
-    # Extract serie_name and season_number from the destination_folder path
-    season_folder = destination_folder.rstrip("/")
-    season_number = season_folder.split("/")[-1]
-    serie_name = season_folder.split("/")[-2]
-
-    # Use regex to find season and episode numbers
-    season_match = re.search(r"(?:S|season)(\d+)", season_number, re.IGNORECASE)
-    if season_match:
-        season_number = season_match.group(1).zfill(2)
-    else:
+    season_folder: str = destination_folder.rstrip("/")
+    season_name: str = season_folder.split("/")[-1]
+    serie_name: str = season_folder.split("/")[-2]
+
+    season_match = SEASON_PATTERN.search(season_name)
+    if season_match is None:
         print(
             colored(
                 "Season number could not be inferred from the folder structure. "
@@ -133,19 +882,30 @@ def rename_files(origin_files: list, destination_folder: str) -> None:
                 attrs=["bold"],
             )
         )
-        return
+        return None
+    return serie_name, season_match.group(1).zfill(2)
 
-    # Perform a dry-run to display the proposed new file names
-    stdout = subprocess.run(
-        ["ssh", f"{server_user}@{server_name}", f'ls -1 "{season_folder}"'],
-        capture_output=True,
-        text=True,
-    ).stdout
-    files = stdout.splitlines()
-    renamed_files = []
-    for file in files:
-        file = file.strip()
-        episode_match = re.search(r"E(\d+)", file, re.IGNORECASE)
+
+def plan_renames(file_names: list, serie_name: str, season_number: str) -> list:
+    """
+    Works out and prints the new names of the episodes of a season.
+
+    Args:
+        file_names (list): The names of the files in the season folder.
+        serie_name (str): The name of the serie.
+        season_number (str): The zero padded season number.
+
+    Returns:
+        list: A list of tuples. Each tuple contains the current and the new file name of
+        a file to rename.
+    """
+    renamed_files: list = []
+    for file in file_names:
+        # hidden files, like macOS' "._" AppleDouble copies, carry the episode number
+        # too and would overwrite the real episode when renamed
+        if file.startswith("."):
+            continue
+        episode_match = EPISODE_PATTERN.search(file)
         if episode_match:
             episode_number = episode_match.group(1)
             file_extension = file.split(".")[-1]
@@ -157,52 +917,98 @@ def rename_files(origin_files: list, destination_folder: str) -> None:
                 print(colored(f"Will rename {file} to {new_file_name}", "yellow"))
         else:
             print(colored(f"Skipping file with no episode number: {file}", "red"))
+    return renamed_files
 
-    # Ask for confirmation to proceed with actual renaming
-    rename_confirmation = input(
-        colored("\nProceed with renaming? [y/n]: ", "yellow", attrs=["bold"])
-    )
+
+def print_rename_plan(source_files: list, destination_folder: str) -> None:
+    """
+    Prints how the copied files would be renamed once on the server.
+
+    Only series are renamed, the rest of the destinations print nothing.
+
+    Args:
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
+        destination_folder (str): The path to the destination folder on the server.
+    """
+    if "series" not in destination_folder:
+        return
+    print(colored("\nIf renamed once copied:", "yellow", attrs=["bold"]))
+    season: tuple = get_season(destination_folder)
+    if season is not None:
+        plan_renames(sorted(file_name for _, file_name in source_files), *season)
+
+
+def rename_files(
+    origin_files: list,
+    destination_folder: str,
+    confirm: Callable[[str], bool] = ask_yes_no,
+) -> None:
+    """
+    Renames files in the destination folder on the server based on a specific pattern.
+
+    This function prompts the user for confirmation, performs a dry-run to display the
+    proposed new file names, and if the user confirms, it renames the files.
+
+    Args:
+        origin_files (list): A list of tuples. Each tuple contains the path of a
+        directory and the list of file names selected in that directory.
+        destination_folder (str): The path to the destination folder on the server.
+        confirm (Callable[[str], bool], optional): Asks a yes/no question and returns
+        the answer. Defaults to ask_yes_no.
+
+    Raises:
+        Exception: If there is an error with the SSH connection or command execution.
+    """
+    if not confirm(
+        colored("Do you want to rename the files? [y/N]: ", "yellow", attrs=["bold"])
+    ):
+        return
     print()
-    if rename_confirmation.lower() in ["y", "yes"]:
-        for old_name, new_name in renamed_files:
-            subprocess.run(
-                [
-                    "ssh",
-                    f"{server_user}@{server_name}",
-                    f'mv "{season_folder}/{old_name}" "{season_folder}/{new_name}"',
-                ]
-            )
-            print(colored(f"- Renamed {old_name} to {new_name}", "green"))
+    season: tuple = get_season(destination_folder)
+    if season is None:
+        return
+
+    # listing and renaming go through SFTP on the pooled connection, no remote shell
+    season_folder: str = destination_folder.rstrip("/")
+    with get_ssh().open_sftp() as sftp:
+        # Perform a dry-run to display the proposed new file names
+        renamed_files: list = plan_renames(sorted(sftp.listdir(season_folder)), *season)
+
+        # Ask for confirmation to proceed with actual renaming
+        rename_confirmation: bool = confirm(
+            colored("\nProceed with renaming? [y/n]: ", "yellow", attrs=["bold"])
+        )
+        print()
+        if rename_confirmation:
+            for old_name, new_name in renamed_files:
+                # overwrites an existing file with the new name, like mv does
+                sftp.posix_rename(
+                    f"{season_folder}/{old_name}", f"{season_folder}/{new_name}"
+                )
+                print(colored(f"- Renamed {old_name} to {new_name}", "green"))
 
 
-def check_files(origin_files: list, destination_folder: str) -> None:
+def check_files(source_files: list, destination_folder: str) -> None:
     """
     Checks files in the destination folder.
 
     This function checks the files in the destination folder on the remote server against
-    the list of origin files. It uses the 'ls -alh' command via ssh to print the details
-    of each file in the destination folder.
+    the list of source files. It runs 'ls -alh' via ssh to print the details of each file
+    in the destination folder, listing up to CHECK_FILES_BATCH_SIZE files per command.
 
     Args:
-        origin_files (list): A list of dictionaries. Each dictionary represents a
-        directory and contains pairs of directory path and list of file names in that
-        directory.
+        source_files (list): A list of tuples. Each tuple contains the source file path
+        and the file name.
         destination_folder (str): The path to the destination folder on the server.
-
-    Raises:
-        subprocess.CalledProcessError: If the subprocess call to ssh fails.
     """
     print(colored("Checking files...", "green", attrs=["bold"]))
-    for full_item in origin_files:
-        for file_names in full_item.values():
-            for file_name in file_names:
-                subprocess.run(
-                    [
-                        "ssh",
-                        f"{server_user}@{server_name}",
-                        f'ls -alh "{destination_folder}{file_name}"',
-                    ]
-                )
+    paths: list = [
+        shlex.quote(f"{destination_folder}{file_name}") for _, file_name in source_files
+    ]
+    for index in range(0, len(paths), CHECK_FILES_BATCH_SIZE):
+        batch: str = " ".join(paths[index : index + CHECK_FILES_BATCH_SIZE])
+        print(run_remote_command(f"ls -alh {batch}"), end="")
 
 
 def check_space() -> None:
@@ -212,16 +1018,15 @@ def check_space() -> None:
     This function checks the available disk space on the destination_base_folder on the
     remote server and prints it to the console.
     """
-    awk = "awk 'NR>1{print $4}'"
-    space_left: bytes = subprocess.check_output(
-        [
-            "ssh",
-            f"{server_user}@{server_name}",
-            (f"df -h {destination_base_folder} | {awk}"),
-        ]
-    )
+    # POSIX output keeps each filesystem on one line, with sizes in 1024-byte blocks
+    output: str = run_remote_command(f"df -Pk {shlex.quote(destination_base_folder)}")
+    lines: list = output.splitlines()
+    if len(lines) < 2:
+        return
+
+    space_left: str = format_size(int(lines[-1].split()[3]) * 1024)
     msg: str = colored("Space left", "green", attrs=["bold"])
-    space_left_msg: str = colored(space_left.decode("utf-8"), "red", attrs=["bold"])
+    space_left_msg: str = colored(space_left, "red", attrs=["bold"])
     print(f"{msg}: {space_left_msg}")
 
 
@@ -231,18 +1036,32 @@ def mount_ask() -> None:
 
     This function asks the user if they want to mount the media folder on the local system
     If the user agrees, the function mounts the media folder. If the user disagrees, the
-    function displays a farewell message and exits the program.
+    function displays a farewell message and exits the program. Nothing is asked when
+    the folder is already mounted.
     """
+    if os.path.ismount(base_folder):
+        print(colored("The media folder is already mounted.", "yellow", attrs=["bold"]))
+        return
+
     mount: str = input("Do you want to mount the media folder? [y/n]: ")
     if mount.lower() in ["", "y", "yes"]:
         message: str = colored("Mounting... (enter password)", "yellow", attrs=["bold"])
         print(message)
-        os.system(
-            (
-                f"sudo mount -o rw -t nfs {server_name}:{destination_base_folder} "
-                f"{base_folder}"
-            )
+        result = subprocess.run(
+            [
+                "sudo",
+                "mount",
+                "-o",
+                "rw",
+                "-t",
+                "nfs",
+                f"{server_name}:{destination_base_folder}",
+                base_folder,
+            ]
         )
+        if result.returncode != 0:
+            message = colored("The media folder could not be mounted.", "red")
+            print(message)
     else:
         bye("Ok, not mounting anything! Bye!")
         sys.exit()
@@ -1,3 +1,8 @@
+import asyncio
+import os
+
+from functools import lru_cache
+
 import requests
 
 from telethon import TelegramClient
@@ -16,6 +21,18 @@ telegram_telethon_client = TelegramClient(
     telegram_personal_nickname, telegram_api_id, telegram_api_hash
 )
 
+# shared HTTP session, keeps connections alive across the OMDB and poster requests
+http_session = requests.Session()
+# seconds to wait for the OMDB and poster servers before giving up
+HTTP_TIMEOUT = 10
+# bytes of the poster held in memory at a time while writing it to disk
+POSTER_CHUNK_SIZE = 64 * 1024
+# posters are kept in the user's own cache, named by IMDB id so titles shared by several
+# films don't get each other's poster
+POSTER_FOLDER = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "cp2toto", "posters"
+)
+
 
 async def test_telegram_client():
     await telegram_telethon_client.start(phone=telegram_personal_phone_number)
@@ -34,16 +51,25 @@ def ask_user_to_send_message():
 
 
 def download_poster(url, file_path):
+    # the poster of a title is only downloaded once
+    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        return True
+
+    os.makedirs(os.path.dirname(file_path), mode=0o700, exist_ok=True)
     try:
-        response = requests.get(url)
-        # Check if the request was successful
-        response.raise_for_status()
-        with open(file_path, "wb") as file:
-            file.write(response.content)
+        with http_session.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            # Check if the request was successful
+            response.raise_for_status()
+            with open(file_path, "wb") as file:
+                for chunk in response.iter_content(POSTER_CHUNK_SIZE):
+                    file.write(chunk)
         print(colored("Poster downloaded successfully!", "green", attrs=["dark"]))
         return True
 
     except requests.exceptions.RequestException as err:
+        # don't leave a partial poster behind to be taken as already downloaded
+        if os.path.exists(file_path):
+            os.remove(file_path)
         msg: str = colored(
             f"An error occurred while downloading the poster: {err}",
             "red",
@@ -55,6 +81,17 @@ def download_poster(url, file_path):
         return False
 
 
+@lru_cache(maxsize=128)
+def fetch_movie_data(movie_name, movie_year):
+    api_url = (
+        f"https://www.omdbapi.com/?apikey={omdb_api_key}"
+        f"&t={movie_name}"
+        f"&y={movie_year}"
+        "&plot=short&r=json"
+    )
+    return http_session.get(api_url, timeout=HTTP_TIMEOUT).json()
+
+
 def check_it_is_the_right_movie(imdb_link):
     msg = colored(
         "check the following imdb link to make sure it's the right media: ",
@@ -79,26 +116,20 @@ def build_telegram_message():
         attrs=["bold"],
     )
     print(msg)
-    movie_name = input(colored("Name: ", "yellow", attrs=["bold"]))
-    movie_year = input(colored("Year: ", "yellow", attrs=["bold"]))
-    if not movie_name or not movie_year:
+    while True:
+        movie_name = input(colored("Name: ", "yellow", attrs=["bold"])).strip()
+        movie_year = input(colored("Year: ", "yellow", attrs=["bold"])).strip()
+        if movie_name and movie_year.isdigit():
+            break
         msg: str = colored(
             "\nMovie name and year are required to send the message. Try again.",
             "red",
             attrs=["bold"],
         )
         print(msg)
-        build_telegram_message()
-
-    api_url = (
-        f"https://www.omdbapi.com/?apikey={omdb_api_key}"
-        f"&t={movie_name}"
-        f"&y={movie_year}"
-        "&plot=short&r=json"
-    )
 
     try:
-        movie_data = requests.get(api_url).json()
+        movie_data = fetch_movie_data(movie_name, movie_year)
 
     except Exception as err:
         msg: str = colored(
@@ -107,14 +138,14 @@ def build_telegram_message():
             attrs=["bold"],
         )
         print(msg)
-        return None, None
+        return None, None, None
 
     try:
         title = movie_data["Title"]
         year = movie_data["Year"]
         plot = movie_data["Plot"]
         poster = movie_data["Poster"]
-        poster_path = f"/tmp/{title}.jpg"
+        poster_path = os.path.join(POSTER_FOLDER, f"{movie_data['imdbID']}.jpg")
 
     except KeyError as err:
         msg: str = colored(
@@ -124,9 +155,7 @@ def build_telegram_message():
         )
         print(msg)
         print(colored(f"movie_data: {movie_data}", "red", attrs=["dark"]))
-        return None, None
-
-    download_poster(poster, poster_path)
+        return None, None, None
 
     imdb_link = f"https://www.imdb.com/title/{movie_data['imdbID']}/"
     imdb_rating = movie_data["imdbRating"]
@@ -152,7 +181,7 @@ def build_telegram_message():
         msg = colored("You're gonna need to this one manually.", "red", attrs=["dark"])
         print(msg)
 
-        return None, None
+        return None, None, None
 
     message = f"""
 **{title}**
@@ -168,24 +197,33 @@ __{plot}__
 🔗 [IMDB]({imdb_link})
 """
 
-    return message, poster_path
+    return message, poster, poster_path
 
 
 async def send_message_to_telegram_channel():
     if ask_user_to_send_message():
-        message, poster_path = build_telegram_message()
+        message, poster, poster_path = build_telegram_message()
         if message:
+            # the poster downloads while the Telegram client connects
+            poster_downloaded, _ = await asyncio.gather(
+                asyncio.to_thread(download_poster, poster, poster_path),
+                telegram_telethon_client.start(phone=telegram_personal_phone_number),
+            )
             print(
                 colored(
                     "Sending message to Telegram channel...", "green", attrs=["dark"]
                 ),
                 end=" ",
             )
-            await telegram_telethon_client.start(phone=telegram_personal_phone_number)
             async with telegram_telethon_client:
-                await telegram_telethon_client.send_file(
-                    telegram_channel_name, poster_path, caption=message
-                )
+                if poster_downloaded:
+                    await telegram_telethon_client.send_file(
+                        telegram_channel_name, poster_path, caption=message
+                    )
+                else:
+                    await telegram_telethon_client.send_message(
+                        telegram_channel_name, message
+                    )
                 icon: str = colored("􀆅 ", "green", attrs=["bold"])
                 print(icon)
     else: